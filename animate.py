@@ -0,0 +1,295 @@
+import io
+import os
+import sys
+import time
+import zlib
+import struct
+import collections
+import argparse
+import itertools
+from concurrent.futures import ProcessPoolExecutor
+from PIL import Image, GifImagePlugin
+import map
+import metar
+import interpolation as engines
+from stations import StationIndex
+
+SNAPSHOT_FILES = ('.csv', '.gz', '.npz')
+#endings of the files in a snapshot directory that are read: METAR csv files,
+#which may be gzip-compressed, and snapshots saved by metar.Snapshot.save
+
+def load_snapshot(path):
+    '''
+    Returns the metar.Snapshot in the file 'path', either a METAR csv file or
+    a snapshot saved by Snapshot.save
+    '''
+    if path.endswith('.npz'):
+        return metar.Snapshot.load(path)
+    return metar.parse(metar.FileSource(path).lines())
+
+def snapshot_paths(directory, hours=None):
+    '''
+    Returns the paths of the snapshot files in 'directory' in the order they
+    were written. With hours, files written more than that many hours before
+    the newest are left out, so they are never read.
+    '''
+    written = {}
+    for name in os.listdir(directory):
+        if name.endswith(SNAPSHOT_FILES):
+            path = os.path.join(directory, name)
+            written[path] = os.stat(path).st_mtime
+    paths = sorted(written, key=lambda path: (written[path], path))
+    if hours is not None and paths:
+        paths = [path for path in paths if written[path] >= written[paths[-1]] - hours*3600]
+    return paths
+
+def newer(snapshots):
+    "Yield the snapshots that are not empty and newer than every snapshot before them"
+    latest = None
+    for snapshot in snapshots:
+        if len(snapshot) and (latest is None or snapshot.times.max() > latest):
+            latest = snapshot.times.max()
+            yield snapshot
+
+def load_snapshots(directory, hours=None, processes=None):
+    '''
+    Yields the snapshots in the files from snapshot_paths, oldest first, as
+    they are needed. They are parsed in parallel by a pool of processes,
+    which reads at most two files a process ahead of the snapshot last
+    yielded, or in this process if processes is 1. Empty snapshots, and
+    snapshots no newer than one already yielded, such as the parsed copy
+    SnapshotCache keeps of each download, are left out.
+    '''
+    paths = snapshot_paths(directory, hours)
+    if processes == 1:
+        yield from newer(load_snapshot(path) for path in paths)
+        return
+    ahead = 2*(processes or os.cpu_count() or 1)
+    with ProcessPoolExecutor(processes) as pool:
+        def parsed():
+            pending = collections.deque()
+            for path in paths:
+                pending.append(pool.submit(load_snapshot, path))
+                if len(pending) > ahead:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        yield from newer(parsed())
+
+class FrameWriter:
+    """
+    Writes the frames of an animation one at a time as they are drawn, so
+    that memory does not grow with the number of frames. Frames are shown
+    for 'duration' milliseconds each, and animations repeat 'loop' times, or
+    forever if loop is 0. Writers close themselves at the end of a with
+    block.
+    """
+
+    def __init__(self, path, duration=500, loop=0):
+        self.path = path
+        self.duration = duration
+        self.loop = loop
+        self.count = 0
+
+    def __repr__(self):
+        return "{}({!r}, {} frames)".format(type(self).__name__, self.path, self.count)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def write(self, image):
+        "Write 'image' as the next frame"
+        raise NotImplementedError
+
+    def close(self):
+        "Finish the animation"
+        pass
+
+class FrameSequence(FrameWriter):
+    """
+    Frames saved as numbered png files, frame0000.png and so on, in the
+    directory 'path', which is created if missing.
+    """
+
+    def __init__(self, path, duration=500, loop=0):
+        super().__init__(path, duration, loop)
+        os.makedirs(path, exist_ok=True)
+
+    def write(self, image):
+        image.save(os.path.join(self.path, 'frame{:04d}.png'.format(self.count)), 'PNG')
+        self.count += 1
+
+class GifWriter(FrameWriter):
+    """
+    Frames written to an animated GIF. Each frame is reduced to 256 colors of
+    its own, kept in a color table in front of the frame, so colors that
+    only appear in later frames are not lost. Transparent parts of a frame
+    are made white.
+    """
+
+    def __init__(self, path, duration=500, loop=0):
+        super().__init__(path, duration, loop)
+        self.fout = open(path, 'wb')
+
+    def write(self, image):
+        if image.mode == 'RGBA':
+            image = Image.alpha_composite(Image.new('RGBA', image.size, 'WHITE'), image)
+        frame = image.convert('RGB').quantize(256, dither=Image.Dither.NONE)
+        if self.count == 0:
+            header, used = GifImagePlugin.getheader(frame, None, {'loop': self.loop})
+            self.fout.write(b''.join(header))
+        self.fout.write(b''.join(GifImagePlugin.getdata(frame, duration=self.duration, include_color_table=True)))
+        self.count += 1
+
+    def close(self):
+        if not self.fout.closed:
+            self.fout.write(b';')
+            #GIF trailer
+            self.fout.close()
+
+class ApngWriter(FrameWriter):
+    """
+    Frames written to an animated PNG, keeping every color. Each frame is
+    encoded as a png of its own and its image data is copied into the
+    animation. The number of frames in the header is filled in when the
+    writer is closed. Frames take the mode, RGB or RGBA, of the first.
+    """
+    SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+    def __init__(self, path, duration=500, loop=0):
+        super().__init__(path, duration, loop)
+        self.fout = open(path, 'wb')
+        self.mode = None
+        self.sequence = 0
+        #sequence number of the next fcTL or fdAT chunk
+        self.actl = None
+
+    def chunk(self, kind, data):
+        "Write a png chunk of type 'kind' holding 'data'"
+        self.fout.write(struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data)))
+
+    @staticmethod
+    def chunks(png):
+        "Yield the type and data of each chunk of the png file in the bytes 'png'"
+        offset = len(ApngWriter.SIGNATURE)
+        while offset < len(png):
+            length, kind = struct.unpack('>I4s', png[offset:offset + 8])
+            yield kind, png[offset + 8:offset + 8 + length]
+            offset += length + 12
+
+    def write(self, image):
+        if self.mode is None:
+            self.mode = 'RGBA' if image.mode == 'RGBA' else 'RGB'
+        buffer = io.BytesIO()
+        image.convert(self.mode).save(buffer, 'PNG')
+        chunks = list(ApngWriter.chunks(buffer.getvalue()))
+        if self.count == 0:
+            self.fout.write(ApngWriter.SIGNATURE)
+            self.chunk(b'IHDR', dict(chunks)[b'IHDR'])
+            self.actl = self.fout.tell()
+            self.chunk(b'acTL', struct.pack('>II', 0, self.loop))
+        self.chunk(b'fcTL', struct.pack('>IIIIIHHBB', self.sequence, image.width, image.height, 0, 0,
+        self.duration, 1000, 0, 0))
+        self.sequence += 1
+        for kind, data in chunks:
+            if kind != b'IDAT':
+                continue
+            if self.count == 0:
+                self.chunk(b'IDAT', data)
+            else:
+                self.chunk(b'fdAT', struct.pack('>I', self.sequence) + data)
+                self.sequence += 1
+        #the first frame is the default image, and later frames are stored as fdAT chunks
+        self.count += 1
+
+    def close(self):
+        if not self.fout.closed:
+            if self.actl is not None:
+                self.chunk(b'IEND', b'')
+                self.fout.seek(self.actl)
+                self.chunk(b'acTL', struct.pack('>II', self.count, self.loop))
+            self.fout.close()
+
+def writer(output, duration=500, loop=0):
+    '''
+    Returns the frame writer for 'output': a GifWriter for a .gif file, an
+    ApngWriter for a .png or .apng file, and a FrameSequence of numbered png
+    files in the directory 'output' otherwise
+    '''
+    extension = os.path.splitext(output)[1].lower()
+    if extension == '.gif':
+        return GifWriter(output, duration, loop)
+    if extension in ('.png', '.apng'):
+        return ApngWriter(output, duration, loop)
+    return FrameSequence(output, duration, loop)
+
+def animate(boundaries, directory, output, section=None, hours=None, duration=500, loop=0, processes=None,
+    interpolation='nearest', **options):
+    """
+    Renders an animation of 'section' with one frame per METAR snapshot in
+    'directory', oldest first, and writes it to 'output' one frame at a time.
+    The snapshots are parsed in parallel as the frames are drawn, so only a
+    few are held in memory however many files the directory has. A station index and interpolator
+    are built for each snapshot, except that a snapshot with the same
+    stations as the one before reuses them, along with the interpolator's
+    stencils. The border and legend layers are drawn once and shared by every
+    frame, and each frame's legend shows the time of its own snapshot.
+    Returns the number of frames and the number of indexes built.
+    Args:
+        boundaries (str): name of a csv file of geographic information
+        directory (str): directory of METAR csv files, which may be
+        gzip-compressed, or of snapshots saved by metar.Snapshot.save
+        output (str): .gif or .png file to save the animation in, or a
+        directory to save numbered frames in
+        section: area of US to animate
+        hours (float): only animate the snapshot files written in this many
+        hours up to the newest
+        duration (int): milliseconds each frame is shown for
+        loop (int): number of times the animation plays, 0 for forever
+        processes (int): number of processes parsing the snapshots, defaulting
+        to the number of CPUs
+        interpolation (str): name of the interpolator in interpolation.ENGINES
+        options: keyword arguments passed on to map.draw
+    """
+    section, regions = map.section_regions(boundaries, section)
+    snapshots = load_snapshots(directory, hours, processes)
+    first = next(snapshots, None)
+    if first is None:
+        raise ValueError('no METAR snapshots found in {}'.format(directory))
+    interpolator = None
+    built = 0
+    with writer(output, duration, loop) as frames:
+        for snapshot in itertools.chain([first], snapshots):
+            if interpolator is not None and interpolator.index.same_stations(snapshot):
+                interpolator = interpolator.with_index(interpolator.index.with_readings(snapshot))
+            else:
+                interpolator = engines.interpolator(interpolation, StationIndex.from_snapshot(snapshot))
+                built += 1
+            frames.write(map.draw(regions, section, snapshot, interpolator=interpolator, **options))
+    return frames.count, built
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Animate a section over a directory of METAR snapshots.')
+    parser.add_argument('boundaries', help='csv file of state boundaries (ex: states.csv)')
+    parser.add_argument('snapshots', help='directory of METAR csv files or saved snapshots')
+    parser.add_argument('output', help='.gif or .png file to save the animation in, or a directory for frames')
+    parser.add_argument('section', nargs='?', default=None, help='section to plot (default: USA)')
+    parser.add_argument('--hours', type=float, default=None, help='only animate the files written in the last HOURS hours')
+    parser.add_argument('--duration', type=int, default=500, help='milliseconds each frame is shown for')
+    parser.add_argument('--loop', type=int, default=0, help='times the animation plays, 0 for forever')
+    parser.add_argument('--processes', type=int, default=None, help='number of processes parsing snapshots')
+    parser.add_argument('--interpolation', choices=list(engines.ENGINES), default='nearest',
+    help='how readings are interpolated between stations')
+    parser.add_argument('--glyphs', choices=['arrows', 'barbs'], default='arrows', help='how wind is drawn')
+    parser.add_argument('--clip', action='store_true', help='only draw inside the boundaries of the section')
+    args = parser.parse_args()
+    start = time.time()
+    try:
+        frames, built = animate(args.boundaries, args.snapshots, args.output, args.section, args.hours,
+        args.duration, args.loop, args.processes, args.interpolation, glyphs=args.glyphs, clip=args.clip)
+    except ValueError as e:
+        sys.exit(str(e))
+    print('wrote {} frames from {} station indexes in {:.1f}s'.format(frames, built, time.time() - start))
@@ -0,0 +1,183 @@
+import os
+import sys
+import time
+import pickle
+import tempfile
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import boundaries as boundarycache
+import map
+import metar
+import interpolation as engines
+from stations import StationIndex
+
+SECTIONS = map.STATES + list(map.REGIONS) + ['USA']
+#every section that can be plotted, in the order they are rendered
+
+_shared = {}
+#state shared by every section rendered in a process: the boundary file name
+#and render options set by share(), and the stations and interpolator of the
+#snapshot being rendered, set by use_snapshot()
+
+def share(boundaries, options):
+    '''
+    Stores the boundary file name and render options for render_section.
+    Runs once in each worker process of a pool.
+    '''
+    _shared.update(boundaries=boundaries, options=options)
+
+def use_snapshot(snapshot, path):
+    '''
+    Makes the stations and interpolator pickled to the file 'path' the ones
+    render_section draws from, unless they are already, as 'snapshot' counts
+    the snapshots a pool has been given. Each worker reads the file once per
+    snapshot rather than having them sent with every section.
+    '''
+    if _shared.get('snapshot') != snapshot:
+        with open(path, 'rb') as fin:
+            _shared['stations'], _shared['interpolator'] = pickle.load(fin)
+        _shared['snapshot'] = snapshot
+
+def render_section(section, outdir, snapshot=None, path=None):
+    '''
+    Renders 'section' from the shared snapshot, read from 'path' first if it
+    is a new one, and saves it as a png named after the section in 'outdir'.
+    The section's layout comes from map.section_layout, so a worker loads
+    the boundaries of each section once for as long as it runs. Returns the
+    name of the saved file.
+    '''
+    if path is not None:
+        use_snapshot(snapshot, path)
+    options = dict(_shared['options'])
+    layout = map.section_layout(_shared['boundaries'], section, options.pop('resolution', 70),
+    options.pop('wind_resolution', 20))
+    output = os.path.join(outdir, layout.section + '.png')
+    map.render(layout.regions, layout.section, _shared['stations'], output, interpolator=_shared['interpolator'],
+    layout=layout, **options)
+    return output
+
+class BatchRenderer:
+    """
+    Renders sections into 'outdir' from one snapshot after another with a
+    pool of worker processes that is started once and kept until the
+    renderer is closed, so that workers keep the layouts of their sections
+    between snapshots. With processes set to 1, sections are rendered in this
+    process. Renderers close themselves at the end of a with block.
+    """
+
+    def __init__(self, boundaries, outdir, processes=None, interpolation='nearest', **options):
+        self.outdir = outdir
+        self.interpolation = interpolation
+        self.snapshots = 0
+        os.makedirs(outdir, exist_ok=True)
+        boundarycache.load(boundaries)
+        #building the boundary cache up front so that workers only read it
+        share(boundaries, options)
+        self.pool = None if processes == 1 else ProcessPoolExecutor(processes, initializer=share,
+        initargs=(boundaries, options))
+
+    def __repr__(self):
+        return "BatchRenderer({!r}, {} snapshots)".format(self.outdir, self.snapshots)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def render(self, stations, sections=SECTIONS):
+        '''
+        Renders every section in 'sections' from the Snapshot 'stations',
+        returning the names of the saved files. The stations are indexed and
+        prepared for interpolation once, here, and any triangulation is sent
+        to the workers with them.
+        '''
+        interpolator = engines.interpolator(self.interpolation, StationIndex.from_snapshot(stations))
+        self.snapshots += 1
+        if self.pool is None:
+            _shared.update(stations=stations, interpolator=interpolator, snapshot=self.snapshots)
+            return [render_section(section, self.outdir) for section in sections]
+        fd, path = tempfile.mkstemp(suffix='.pickle')
+        try:
+            with os.fdopen(fd, 'wb') as fout:
+                pickle.dump((stations, interpolator), fout, pickle.HIGHEST_PROTOCOL)
+            n = len(sections)
+            return list(self.pool.map(render_section, sections, [self.outdir]*n, [self.snapshots]*n, [path]*n))
+        finally:
+            os.remove(path)
+
+    def close(self):
+        "Shut down the pool of workers"
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+
+def render_all(boundaries, outdir, sections=SECTIONS, location=map.URL, processes=None, cache=None,
+    interpolation='nearest', **options):
+    """
+    Renders every section in 'sections' into 'outdir' from a single fetch of
+    the METAR data, returning the names of the saved files.
+    The boundary cache is built and the stations are fetched, indexed and
+    prepared for interpolation once, then the sections are rendered in
+    parallel by a BatchRenderer.
+    Args:
+        boundaries (str): name of a csv file of geographic information
+        outdir (str): directory to save the images in, created if missing
+        sections (list): names of the sections to plot
+        location: URL or csv file name of the METAR data, or a source object
+        from metar.py
+        processes (int): number of worker processes, defaulting to the number
+        of CPUs; 1 renders every section in this process
+        cache (SnapshotCache): on-disk cache that URLs are fetched through
+        interpolation (str): name of the interpolator in interpolation.ENGINES
+        options: keyword arguments passed on to map.render
+    """
+    stations = map.fetch_stations(location, cache)
+    with BatchRenderer(boundaries, outdir, processes, interpolation, **options) as renderer:
+        return renderer.render(stations, sections)
+
+def serve(boundaries, outdir, sections=SECTIONS, location=map.URL, processes=None, cache=None,
+    interval=300, interpolation='nearest', **options):
+    '''
+    Renders every section into 'outdir' once every 'interval' seconds until
+    interrupted, reporting each cycle on stdout. One BatchRenderer, and its
+    pool of workers, is kept for the whole run.
+    '''
+    with BatchRenderer(boundaries, outdir, processes, interpolation, **options) as renderer:
+        while True:
+            start = time.time()
+            try:
+                outputs = renderer.render(map.fetch_stations(location, cache), sections)
+                print('rendered {} sections in {:.1f}s'.format(len(outputs), time.time() - start))
+            except Exception as e:
+                print('render failed: {}'.format(e), file=sys.stderr)
+                #a failed cycle, such as an unreachable feed, is retried next cycle
+            sys.stdout.flush()
+            time.sleep(max(0, interval - (time.time() - start)))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Render many sections from one fetch of METAR data.')
+    parser.add_argument('boundaries', help='csv file of state boundaries (ex: states.csv)')
+    parser.add_argument('outdir', help='directory to save the images in')
+    parser.add_argument('sections', nargs='*', default=SECTIONS, help='sections to plot (default: all)')
+    parser.add_argument('--source', default=map.URL, help='URL or csv file of METAR data')
+    parser.add_argument('--processes', type=int, default=None, help='number of worker processes')
+    parser.add_argument('--interval', type=float, default=None,
+    help='keep running, rendering again every INTERVAL seconds')
+    parser.add_argument('--cache-dir', default='metar_cache',
+    help='directory that downloaded METAR data is kept in')
+    parser.add_argument('--max-age', type=float, default=300,
+    help='seconds that downloaded METAR data is reused for before checking for newer data')
+    parser.add_argument('--interpolation', choices=list(engines.ENGINES), default='nearest',
+    help='how readings are interpolated between stations')
+    parser.add_argument('--glyphs', choices=['arrows', 'barbs'], default='arrows', help='how wind is drawn')
+    parser.add_argument('--clip', action='store_true', help='only draw inside the boundaries of each section')
+    parser.add_argument('--transparent', action='store_true', help='leave the map transparent where nothing is drawn')
+    args = parser.parse_args()
+    cache = metar.SnapshotCache(args.cache_dir, args.max_age)
+    if args.interval is None:
+        render_all(args.boundaries, args.outdir, args.sections, args.source, args.processes, cache,
+        args.interpolation, glyphs=args.glyphs, clip=args.clip, transparent=args.transparent)
+    else:
+        serve(args.boundaries, args.outdir, args.sections, args.source, args.processes, cache, args.interval,
+        args.interpolation, glyphs=args.glyphs, clip=args.clip, transparent=args.transparent)
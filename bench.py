@@ -0,0 +1,173 @@
+import os
+import io
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import tempfile
+import numpy as np
+import PIL
+import map
+import boundaries as boundarycache
+from plot import Plot
+from region import Grid
+import interpolation as engines
+from stations import StationIndex
+
+HEADER = ('raw_text,station_id,observation_time,latitude,longitude,temp_c,dewpoint_c,wind_dir_degrees,'
+'wind_speed_kt,wind_gust_kt,visibility_statute_mi,altim_in_hg')
+#header row of the aviationweather.gov METAR csv layout, up to the columns that are read
+
+def synthetic_metars(path, stations, seed=0, timestamp='2024-01-15T18:53:00Z'):
+    '''
+    Writes a METAR csv file in the aviationweather.gov layout to 'path' with
+    'stations' stations spread over North America, with temperatures that fall
+    with latitude and random winds. About one row in thirty has a missing value,
+    as in the real feed.
+    '''
+    rnd = random.Random(seed)
+    with open(path, 'w') as fout:
+        fout.write('No errors\nNo warnings\n{} ms\ndata source=metars\n{} results\n'.format(rnd.randint(5, 50), stations))
+        fout.write(HEADER + '\n')
+        for i in range(stations):
+            lat = rnd.uniform(15, 60)
+            lon = rnd.uniform(-135, -55)
+            temp = round(35 - (lat - 15)*1.2 + rnd.gauss(0, 3), 1)
+            direction = rnd.randrange(0, 360, 10)
+            speed = rnd.randint(0, 35)
+            if rnd.random() < 1/30:
+                temp = ''
+            fout.write('METAR S{:05d},S{:05d},{},{:.4f},{:.4f},{},{},{},{},,10.0,30.01\n'.format(i, i, timestamp,
+            lat, lon, temp, 0.0, direction, speed))
+
+class Timer:
+    """
+    Collects the time taken by each named stage of a run.
+    """
+
+    def __init__(self):
+        self.stages = {}
+
+    def __call__(self, stage, fn, *args, **kwargs):
+        "Run fn(*args, **kwargs), adding its time to 'stage', and return its result"
+        start = time.perf_counter()
+        result = fn(*args, **kwargs)
+        self.stages[stage] = self.stages.get(stage, 0) + time.perf_counter() - start
+        return result
+
+def run(boundaries, metars, section, resolution=70, wind_resolution=20, legacy=False,
+    interpolation='nearest', glyphs='arrows', clip=False):
+    '''
+    Renders 'section' once from the METAR file 'metars', timing each stage of
+    the pipeline, and returns a dict of the seconds taken by each stage. With
+    legacy, the Region-per-cell grid, interpolation and drawing stages are
+    timed as well. 'interpolation' names the interpolator in
+    interpolation.ENGINES that is timed, and 'glyphs' is 'arrows' or 'barbs'.
+    With clip, only the cells inside the section are interpolated and drawn,
+    and building the section mask is timed as well.
+    '''
+    Plot._layers.clear()
+    Plot._sprites.clear()
+    #static layers are cached across renders in one process, and are timed cold
+    t = Timer()
+    name, regions = t('boundary_load', map.section_regions, boundaries, section)
+    stations = t('metar_parse', map.fetch_stations, metars)
+    index = t('index_build', StationIndex.from_snapshot, stations)
+    interpolator = t('interpolator_fit', engines.interpolator, interpolation, index)
+    bounds = map.bounding_box(regions)
+    MINLONG, MINLAT, MAXLONG, MAXLAT = bounds
+    p = Plot(*bounds)
+    g = t('grid', Grid, MINLONG, MAXLONG, MINLAT, MAXLAT, resolution, resolution)
+    h = t('grid', Grid, MINLONG, MAXLONG, MINLAT, MAXLAT, wind_resolution, wind_resolution)
+    xs, ys = h.midpoints()
+    cells = wind_cells = mask = None
+    if clip:
+        mask = t('mask', p.section_mask, regions, name)
+        cells = t('mask', p.section_cells, regions, name, g)
+        wind_cells = t('mask', p.section_points, regions, name, xs, ys)
+    temps = t('interpolate', interpolator.interpolate, g, index.temps, cells)
+    w_speeds, w_directions = t('interpolate', interpolator.wind, h, wind_cells)
+    if clip:
+        xs, ys, w_speeds, w_directions = xs[wind_cells], ys[wind_cells], w_speeds[wind_cells], w_directions[wind_cells]
+    t('rasterize', p.draw_field, g, temps, map.COLORS, cells, mask)
+    if glyphs == 'barbs':
+        t('draw_barbs', p.draw_barbs, xs, ys, w_speeds, w_directions, 'BLACK')
+    else:
+        t('draw_arrow', p.draw_arrows, xs, ys, w_speeds, w_directions, 'BLACK', 1)
+    t('borders', p.draw_borders, regions, name)
+    t('legend', p.draw_legend, name, map.time_and_date(stations.timestamp()), map.COLORS, glyphs)
+    t('png_save', p.image.save, io.BytesIO(), 'PNG')
+    if legacy:
+        cells = t('grid_regions', map.grid, MINLONG, MAXLONG, MINLAT, MAXLAT, False, resolution)
+        values = t('interpolate_regions', lambda: [square.temp_and_wind(index)[0] for square in cells])
+        t('rasterize_regions', lambda: [p.draw(square, map.COLORS[min(max(int(v), -30), 50)])
+        for square, v in zip(cells, values)])
+    return t.stages
+
+def compare(baseline, results, tolerance, floor=0.005):
+    '''
+    Prints every stage of 'results' that is more than 'tolerance' times and
+    more than 'floor' seconds slower than the same stage of the same case in
+    'baseline', and returns the number of such stages
+    '''
+    key = lambda r: (r['stations'], r['section'], r['resolution'], r['wind_resolution'],
+    r.get('interpolation', 'nearest'), r.get('clip', False))
+    before = {key(r): r['stages'] for r in baseline['results']}
+    slower = 0
+    for r in results['results']:
+        for stage, seconds in sorted(r['stages'].items()):
+            old = before.get(key(r), {}).get(stage)
+            if old and seconds > old*tolerance and seconds - old > floor:
+                print('slower: {} {}: {:.4f}s -> {:.4f}s'.format(key(r), stage, old, seconds))
+                slower += 1
+    return slower
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Time each stage of rendering maps from synthetic METAR data.')
+    parser.add_argument('--boundaries', default='states.csv', help='csv file of state boundaries')
+    parser.add_argument('--stations', type=int, nargs='+', default=[1000, 10000, 50000],
+    help='numbers of synthetic stations')
+    parser.add_argument('--sections', nargs='+', default=['Rhode_Island', 'New_England', 'USA'],
+    help='sections to render')
+    parser.add_argument('--resolutions', type=int, nargs='+', default=[70, 150, 300],
+    help='temperature grid resolutions')
+    parser.add_argument('--wind-resolution', type=int, default=20, help='wind grid resolution')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per case, of which the fastest is kept')
+    parser.add_argument('--interpolation', nargs='+', choices=list(engines.ENGINES), default=['nearest'],
+    help='interpolators to time')
+    parser.add_argument('--glyphs', choices=['arrows', 'barbs'], default='arrows', help='how wind is drawn')
+    parser.add_argument('--clip', action='store_true', help='only interpolate and draw inside each section')
+    parser.add_argument('--legacy', action='store_true', help='also time the Region-per-cell stages')
+    parser.add_argument('--output', default='bench.json', help='json file to save the results in')
+    parser.add_argument('--compare', help='json file of earlier results to compare against')
+    parser.add_argument('--tolerance', type=float, default=1.25,
+    help='how many times slower a stage may be than in --compare before it is reported')
+    args = parser.parse_args()
+    results = {'meta': {'python': platform.python_version(), 'numpy': np.__version__, 'pillow': PIL.__version__,
+    'machine': platform.machine(), 'date': time.strftime('%Y-%m-%dT%H:%M:%S')}, 'results': []}
+    boundarycache.load(args.boundaries)
+    #building the boundary cache up front, so that boundary_load times the cached path
+    with tempfile.TemporaryDirectory() as tmp:
+        for n in args.stations:
+            metars = os.path.join(tmp, 'metars{}.csv'.format(n))
+            synthetic_metars(metars, n)
+            for section in args.sections:
+                for resolution in args.resolutions:
+                    for interpolation in args.interpolation:
+                        runs = [run(args.boundaries, metars, section, resolution, args.wind_resolution, args.legacy,
+                        interpolation, args.glyphs, args.clip) for i in range(args.repeat)]
+                        stages = {stage: min(r[stage] for r in runs) for stage in runs[0]}
+                        total = sum(seconds for stage, seconds in stages.items() if not stage.endswith('_regions'))
+                        #legacy stages repeat the work of others, so are left out of the total
+                        results['results'].append({'stations': n, 'section': section, 'resolution': resolution,
+                        'wind_resolution': args.wind_resolution, 'interpolation': interpolation, 'clip': args.clip,
+                        'stages': stages, 'total': total})
+                        print('{:>6} stations {:>14} {:>4}x{:<4} {:>8} {:.3f}s'.format(n, section, resolution,
+                        resolution, interpolation, total))
+    with open(args.output, 'w') as fout:
+        json.dump(results, fout, indent=1)
+    if args.compare:
+        with open(args.compare, 'r') as fin:
+            sys.exit(1 if compare(json.load(fin), results, args.tolerance) else 0)
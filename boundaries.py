@@ -0,0 +1,100 @@
+import sys
+import os
+import csv
+import json
+import numpy as np
+from region import mercator
+
+def cache_paths(source):
+    '''
+    Returns the paths of the binary coordinate file and the json index that
+    cache the boundary csv file 'source'
+    '''
+    return source + '.cache.npy', source + '.cache.json'
+
+def source_stamp(source):
+    '''
+    Returns the modification time and size of 'source', used to tell whether
+    a cache built from it is stale
+    '''
+    stat = os.stat(source)
+    return {'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size}
+
+def parse(source):
+    '''
+    Reads a csv file of boundaries where each row holds a name, a country and
+    then interleaved long/lat values. Returns the names of the rows, a flat
+    n x 2 array of every row's long and mercator lat values, and a list of
+    offsets where row i's coordinates are coords[offsets[i]:offsets[i+1]].
+    '''
+    names = []
+    coords = []
+    offsets = [0]
+    with open(source, 'r') as fin:
+        for row in csv.reader(fin):
+            names.append(row[0])
+            i = 2
+            j = 3
+            while i<len(row) and j<len(row):
+                coords.append((float(row[i]), mercator(float(row[j]))))
+                i+=2
+                j+=2
+            offsets.append(len(coords))
+    return names, np.array(coords, dtype=float).reshape(-1, 2), offsets
+
+def build_cache(source):
+    '''
+    Parses the boundary csv file 'source' and writes its projected coordinates
+    to a flat binary file, with a json index of the name and offsets of each
+    row and the stamp of the source it was built from. Returns the parsed
+    names, coordinates and offsets.
+    '''
+    names, coords, offsets = parse(source)
+    datapath, indexpath = cache_paths(source)
+    index = {'source': source_stamp(source), 'names': names, 'offsets': offsets}
+    try:
+        with open(datapath + '.tmp', 'wb') as fout:
+            np.save(fout, coords)
+        with open(indexpath + '.tmp', 'w') as fout:
+            json.dump(index, fout)
+        os.replace(datapath + '.tmp', datapath)
+        os.replace(indexpath + '.tmp', indexpath)
+        #files are renamed into place so a reader never sees a partial cache
+    except OSError:
+        pass
+        #an unwritable cache only costs parsing the csv again next time
+    return names, coords, offsets
+
+def load(source):
+    '''
+    Returns the names, coordinates and offsets of the boundary csv file
+    'source' as parse does, reading them from the cache when it is up to date
+    and rebuilding it otherwise. The coordinates are memory-mapped, so only
+    the rows that are used are read from disk.
+    '''
+    datapath, indexpath = cache_paths(source)
+    try:
+        with open(indexpath, 'r') as fin:
+            index = json.load(fin)
+        if index['source'] == source_stamp(source):
+            return index['names'], np.load(datapath, mmap_mode='r'), index['offsets']
+    except (OSError, ValueError, KeyError):
+        pass
+    return build_cache(source)
+
+def load_boundaries(source, names=None):
+    '''
+    Returns a list of n x 2 arrays of the long and mercator lat values of
+    every row of the boundary csv file 'source' whose name is in 'names',
+    ordered as in 'names' and then as in the file. All rows are returned if
+    'names' is None.
+    '''
+    rownames, coords, offsets = load(source)
+    if names is None:
+        rows = range(len(rownames))
+    else:
+        rows = [i for name in names for i in range(len(rownames)) if rownames[i] == name]
+    return [np.array(coords[offsets[i]:offsets[i+1]]) for i in rows]
+
+if __name__ == '__main__':
+    build_cache(sys.argv[1])
@@ -0,0 +1,196 @@
+import sys
+import time
+import argparse
+import numpy as np
+from PIL import Image
+import map
+import metar
+from plot import Plot
+from region import Grid
+from stations import StationIndex
+
+class IncrementalRenderer:
+    """
+    Renders one section again and again from successive METAR snapshots.
+    Each update diffs the new snapshot against the previous one by station
+    id, and only the grid cells whose nearest stations were added, removed,
+    moved or changed their readings are interpolated again. Temperature cells
+    whose color changed are repainted in place, the wind arrows are redrawn
+    on a layer of their own only when a wind cell changed, and the cached
+    state border and legend layers of Plot are composited on top of every
+    frame.
+    """
+    CHUNK = 256
+    #number of added stations compared against every cell at a time
+
+    def __init__(self, regions, section, resolution=70, wind_resolution=20, k=3, glyphs='arrows'):
+        self.section = section
+        self.k = k
+        self.glyphs = glyphs
+        bounds = map.bounding_box(regions)
+        MINLONG, MINLAT, MAXLONG, MAXLAT = bounds
+        self.plot = Plot(*bounds)
+        #the temperature field is painted onto the image of this plot
+        self.grids = {'temp': Grid(MINLONG,MAXLONG,MINLAT,MAXLAT,resolution,resolution),
+        'wind': Grid(MINLONG,MAXLONG,MINLAT,MAXLAT,wind_resolution,wind_resolution)}
+        self.cells = {}
+        #for each grid, the flattened midpoints of its cells and, once sampled,
+        #the ids of each cell's nearest stations, the distance to the furthest
+        #of them, and the averaged temp, wind speed and wind direction
+        for name, g in self.grids.items():
+            xs, ys = g.midpoints()
+            self.cells[name] = {'xs': xs.ravel(), 'ys': ys.ravel()}
+        self.regions = regions
+        self.layer = Plot(*bounds)
+        #plot used to draw the transparent arrow layer and to composite frames
+        self.arrows = self.transparent()
+        self.snapshot = None
+
+    def transparent(self):
+        "Return a fully transparent image the size of the plot"
+        return Image.new('RGBA', self.plot.image.size, (0, 0, 0, 0))
+
+    def diff(self, snapshot):
+        '''
+        Compares 'snapshot' with the previous snapshot by station id. Returns
+        the ids of the stations whose previous readings are no longer valid,
+        being removed, moved or changed, and the indices in 'snapshot' of the
+        stations that are new, moved or changed. Stations whose id appears
+        more than once are always treated as changed.
+        '''
+        old, new = self.snapshot, snapshot
+        old_ids, old_first, old_counts = np.unique(old.station_ids, return_index=True, return_counts=True)
+        new_ids, new_first, new_counts = np.unique(new.station_ids, return_index=True, return_counts=True)
+        common, in_old, in_new = np.intersect1d(old_ids, new_ids, assume_unique=True, return_indices=True)
+        i, j = old_first[in_old], new_first[in_new]
+        same = (old_counts[in_old] == 1) & (new_counts[in_new] == 1)
+        for column in ('longs', 'lats', 'temps', 'wind_speeds', 'wind_directions'):
+            same &= getattr(old, column)[i] == getattr(new, column)[j]
+        unchanged = common[same]
+        stale = np.setdiff1d(old_ids, unchanged, assume_unique=True)
+        added = np.flatnonzero(~np.isin(new.station_ids, unchanged))
+        return stale, added
+
+    def affected(self, cells, snapshot, stale, added):
+        '''
+        Returns a boolean array of the cells whose nearest stations include a
+        stale station, or that are closer to an added station than to the
+        furthest of their nearest stations.
+        '''
+        mask = np.isin(cells['ids'], stale).any(axis=1)
+        for start in range(0, len(added), IncrementalRenderer.CHUNK):
+            chunk = added[start:start + IncrementalRenderer.CHUNK]
+            dists = np.hypot(cells['xs'][:, None] - snapshot.longs[chunk], cells['ys'][:, None] - snapshot.lats[chunk])
+            mask |= (dists < cells['reach'][:, None]).any(axis=1)
+        return mask
+
+    def sample(self, cells, index, snapshot, mask):
+        '''
+        Interpolates the cells selected by 'mask' from their nearest stations
+        in 'index', storing the stations' ids and the readings in 'cells'.
+        Returns the previous readings of the selected cells.
+        '''
+        closest = index.nearest_batch(cells['xs'][mask], cells['ys'][mask], self.k)
+        old = cells['values'][mask]
+        cells['ids'][mask] = snapshot.station_ids[closest]
+        cells['reach'][mask] = np.hypot(index.longs[closest[:, -1]] - cells['xs'][mask],
+        index.lats[closest[:, -1]] - cells['ys'][mask])
+        cells['values'][mask] = np.stack(index.readings(closest), axis=1)
+        return old
+
+    def update(self, snapshot):
+        """
+        Brings the frame up to date with 'snapshot', returning the number of
+        temperature cells and wind cells that were interpolated again.
+        """
+        index = StationIndex.from_snapshot(snapshot)
+        first = self.snapshot is None
+        if first:
+            for cells in self.cells.values():
+                n = len(cells['xs'])
+                cells['ids'] = np.empty((n, min(self.k, len(index))), dtype=snapshot.station_ids.dtype)
+                cells['reach'] = np.zeros(n)
+                cells['values'] = np.full((n, 3), np.nan)
+            masks = {name: np.ones(len(cells['xs']), dtype=bool) for name, cells in self.cells.items()}
+        else:
+            stale, added = self.diff(snapshot)
+            if len(stale) == 0 and len(added) == 0:
+                self.snapshot = snapshot
+                return 0, 0
+            masks = {}
+            for name, cells in self.cells.items():
+                if cells['ids'].dtype.itemsize < snapshot.station_ids.dtype.itemsize:
+                    cells['ids'] = cells['ids'].astype(snapshot.station_ids.dtype)
+                #widening the stored ids if the new snapshot has longer ones
+                masks[name] = self.affected(cells, snapshot, stale, added)
+        temp, wind = self.cells['temp'], self.cells['wind']
+        g = self.grids['temp']
+        old = self.sample(temp, index, snapshot, masks['temp'])
+        if first:
+            self.plot.draw_field(g, temp['values'][:, 0].reshape(g.shape()), map.COLORS)
+        else:
+            recolor = np.flatnonzero(masks['temp'])[Plot.color_indices(old[:, 0], map.COLORS) !=
+            Plot.color_indices(temp['values'][masks['temp'], 0], map.COLORS)]
+            #only cells whose color changed need repainting
+            self.plot.draw_cells(g, recolor//g.cols, recolor%g.cols, temp['values'][recolor, 0], map.COLORS)
+        old = self.sample(wind, index, snapshot, masks['wind'])
+        if first or (old[:, 1:] != wind['values'][masks['wind'], 1:]).any():
+            self.arrows = self.transparent()
+            self.layer.image = self.arrows
+            if self.glyphs == 'barbs':
+                self.layer.draw_barbs(wind['xs'], wind['ys'], wind['values'][:, 1], wind['values'][:, 2], 'BLACK')
+            else:
+                self.layer.draw_arrows(wind['xs'], wind['ys'], wind['values'][:, 1], wind['values'][:, 2], 'BLACK', 1)
+        #arrows reach over neighbouring cells, so the whole layer is redrawn
+        self.snapshot = snapshot
+        return int(masks['temp'].sum()), int(masks['wind'].sum())
+
+    def image(self):
+        "Return the current frame with the borders and legend composited on top"
+        frame = self.plot.image.copy()
+        frame.paste(self.arrows, (0, 0), self.arrows)
+        self.layer.image = frame
+        self.layer.draw_borders(self.regions, self.section)
+        self.layer.draw_legend(self.section, map.time_and_date(self.snapshot.timestamp()), map.COLORS, self.glyphs)
+        return frame
+
+    def render(self, snapshot, output):
+        '''
+        Updates the frame with 'snapshot' and saves it to 'output', returning
+        the numbers of cells interpolated again as update does
+        '''
+        counts = self.update(snapshot)
+        self.image().save(output, 'PNG')
+        return counts
+
+def nowcast(boundaries, output, section=None, location=map.URL, cache=None, interval=60, **options):
+    '''
+    Renders 'section' to 'output' once every 'interval' seconds until
+    interrupted, recomputing only what changed since the last snapshot and
+    reporting each refresh on stdout.
+    '''
+    section, regions = map.section_regions(boundaries, section)
+    renderer = IncrementalRenderer(regions, section, **options)
+    while True:
+        start = time.time()
+        try:
+            temps, winds = renderer.render(map.fetch_stations(location, cache), output)
+            print('recomputed {} temperature and {} wind cells in {:.2f}s'.format(temps, winds, time.time() - start))
+        except Exception as e:
+            print('render failed: {}'.format(e), file=sys.stderr)
+        sys.stdout.flush()
+        time.sleep(max(0, interval - (time.time() - start)))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Keep a map up to date, redrawing only what changed.')
+    parser.add_argument('boundaries', help='csv file of state boundaries (ex: states.csv)')
+    parser.add_argument('output', help='file to save the image in')
+    parser.add_argument('section', nargs='?', default=None, help='section to plot (default: USA)')
+    parser.add_argument('--source', default=map.URL, help='URL or csv file of METAR data')
+    parser.add_argument('--interval', type=float, default=60, help='seconds between refreshes')
+    parser.add_argument('--cache-dir', default='metar_cache',
+    help='directory that downloaded METAR data is kept in')
+    parser.add_argument('--glyphs', choices=['arrows', 'barbs'], default='arrows', help='how wind is drawn')
+    args = parser.parse_args()
+    cache = metar.SnapshotCache(args.cache_dir, min(args.interval, 300))
+    nowcast(args.boundaries, args.output, args.section, args.source, cache, args.interval, glyphs=args.glyphs)
@@ -0,0 +1,109 @@
+import json
+import time
+import cProfile
+import contextlib
+
+_report = None
+#report being recorded, or None while instrumentation is off
+
+_idle = contextlib.nullcontext()
+#stage returned while instrumentation is off, reused by every caller
+
+class Report:
+    """
+    The seconds spent in each named stage of a run and the totals of each
+    named counter, collected while recording. Time spent in a stage inside
+    another stage counts towards both.
+    """
+
+    def __init__(self):
+        self.stages = {}
+        self.counts = {}
+        self.calls = {}
+        self.started = time.perf_counter()
+        self.total = None
+
+    def __repr__(self):
+        return "Report({} stages, {} counters)".format(len(self.stages), len(self.counts))
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        "Add the time spent in the with block to the stage 'name'"
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0) + time.perf_counter() - start
+            self.calls[name] = self.calls.get(name, 0) + 1
+
+    def as_dict(self):
+        """
+        Return the report as a dict of plain values: the total seconds, the
+        seconds and number of calls of each stage, each counter, and the
+        stations scanned per cell interpolated if both were counted
+        """
+        report = {'total': self.total if self.total is not None else time.perf_counter() - self.started,
+        'stages': {name: {'seconds': seconds, 'calls': self.calls[name]} for name, seconds in self.stages.items()},
+        'counts': dict(self.counts)}
+        if self.counts.get('cells_interpolated') and 'stations_scanned' in self.counts:
+            report['stations_per_cell'] = self.counts['stations_scanned']/self.counts['cells_interpolated']
+        return report
+
+    def format(self):
+        "Return the report as lines of text, slowest stage first"
+        report = self.as_dict()
+        lines = ['total {:.4f}s'.format(report['total'])]
+        for name, stage in sorted(report['stages'].items(), key=lambda item: -item[1]['seconds']):
+            lines.append('{:>20} {:.4f}s {:>7} calls'.format(name, stage['seconds'], stage['calls']))
+        for name, value in sorted(report['counts'].items()):
+            lines.append('{:>20} {}'.format(name, value))
+        if 'stations_per_cell' in report:
+            lines.append('{:>20} {:.1f}'.format('stations_per_cell', report['stations_per_cell']))
+        return '\n'.join(lines)
+
+    def save(self, path):
+        "Save the report as json to 'path'"
+        with open(path, 'w') as fout:
+            json.dump(self.as_dict(), fout, indent=1)
+
+def active():
+    "Return the report being recorded, or None while instrumentation is off"
+    return _report
+
+def stage(name):
+    '''
+    Returns a context manager timing its with block as the stage 'name' of
+    the report being recorded, or one that does nothing while
+    instrumentation is off
+    '''
+    if _report is None:
+        return _idle
+    return _report.stage(name)
+
+def count(name, n=1):
+    "Add n to the counter 'name' of the report being recorded, if there is one"
+    if _report is not None:
+        _report.counts[name] = _report.counts.get(name, 0) + n
+
+@contextlib.contextmanager
+def recording(profile=None):
+    '''
+    Records the stages and counters of everything run in the with block,
+    yielding the Report they are collected in. With profile, the block is
+    also run under cProfile and the statistics are saved to the file
+    'profile', to be read with pstats.
+    '''
+    global _report
+    outer = _report
+    report = _report = Report()
+    profiler = cProfile.Profile() if profile else None
+    if profiler is not None:
+        profiler.enable()
+    try:
+        yield report
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(profile)
+        report.total = time.perf_counter() - report.started
+        _report = outer
@@ -0,0 +1,409 @@
+import copy
+import numpy as np
+import instrument
+from stations import wind_polar
+try:
+    from scipy.spatial import Delaunay
+except ImportError:
+    Delaunay = None
+#scipy is only needed by the linear and natural neighbour interpolators
+
+class Stencil:
+    """
+    The stations and weights that make up the interpolated value at each of
+    a set of points, as two points x width arrays. The value at point i is
+    the sum of weights[i] times the stations' readings, divided by the sum of
+    weights[i]. Rows with fewer stations than width are padded with weight 0.
+    """
+
+    def __init__(self, stations, weights):
+        self.stations = stations
+        self.weights = weights
+        self.total = weights.sum(axis=1)
+
+    def __len__(self):
+        return len(self.stations)
+
+    def apply(self, values):
+        "Return the interpolated value at each point of an array of one reading per station"
+        return (values[self.stations]*self.weights).sum(axis=1)/self.total
+
+def coincident(n, m):
+    '''
+    Returns, for each of m cells dividing a span equally, the cell of n cells
+    dividing the same span whose midpoint is at the same place, or -1 where
+    there is none. Midpoints coincide where n*(2j + 1) = m*(2i + 1), such as
+    on every cell of a grid whose resolution divides the other's by an odd
+    factor.
+    '''
+    twice = n*(2*np.arange(m) + 1) - m
+    return np.where(twice % (2*m) == 0, twice // (2*m), -1)
+
+class Interpolator:
+    """
+    Interpolates station readings onto a Grid. An interpolator is built once
+    per snapshot from its StationIndex and does any work that only depends on
+    the stations, such as triangulating them, up front. The stencil of each
+    grid is worked out the first time the grid is used and kept, so every
+    reading interpolated onto a grid, and every section drawn with the same
+    grid, reuses it. A new grid over the same box as a kept one, such as a
+    wind grid over a temperature grid, takes the rows of the midpoints the
+    two grids share from the kept stencil.
+    """
+    K = 3
+    #number of nearest stations used by interpolators that search the index
+
+    def __init__(self, index, k=None):
+        self.index = index
+        self.k = k or self.K
+        self.stencils = {}
+        self.lattices = {}
+        #the grid of each kept stencil and the row of the stencil of each of
+        #its cells, -1 for cells it does not cover
+
+    def __repr__(self):
+        return "{}({} stations)".format(type(self).__name__, len(self.index))
+
+    def with_index(self, index):
+        """
+        Return an interpolator of 'index', which must hold the same stations
+        at the same positions as this interpolator's index, sharing this
+        interpolator's triangulation and stencils, which only depend on where
+        the stations are
+        """
+        other = copy.copy(self)
+        other.index = index
+        return other
+
+    def stencil(self, grid, cells=None):
+        """
+        Return the stencil of the midpoints of the cells of 'grid', or only of
+        those selected by the rows x cols boolean array 'cells'
+        """
+        key = grid.key() if cells is None else (grid.key(), np.packbits(cells).tobytes())
+        if key not in self.stencils:
+            with instrument.stage('stencil'):
+                self.stencils[key] = self.weigh_shared(grid, cells)
+            selected = np.ones(grid.shape(), dtype=bool) if cells is None else cells
+            rows = np.full(grid.shape(), -1)
+            rows[selected] = np.arange(int(selected.sum()))
+            self.lattices[key] = (grid, rows)
+        return self.stencils[key]
+
+    def weigh_shared(self, grid, cells=None):
+        """
+        Return a new stencil for the midpoints of the cells of 'grid', or of
+        those selected by 'cells', as weigh does, except that midpoints that
+        coincide with those of a kept stencil's grid over the same box take
+        their rows from that stencil rather than being weighed again
+        """
+        selected = np.ones(grid.shape(), dtype=bool) if cells is None else cells
+        remaining = selected.copy()
+        parts = []
+        for key, (other, rows) in self.lattices.items():
+            if other.key()[:4] != grid.key()[:4] or not remaining.any():
+                continue
+            r, c = coincident(other.rows, grid.rows), coincident(other.cols, grid.cols)
+            shared = np.full(grid.shape(), -1)
+            shared[np.ix_(r >= 0, c >= 0)] = rows[np.ix_(r[r >= 0], c[c >= 0])]
+            take = remaining & (shared >= 0)
+            if take.any():
+                parts.append((take, self.stencils[key].stations[shared[take]], self.stencils[key].weights[shared[take]]))
+                remaining &= ~take
+        if not parts:
+            return self.weigh(grid, cells)
+        instrument.count('cells_shared', int((selected & ~remaining).sum()))
+        if remaining.any():
+            xs, ys = grid.midpoints()
+            fresh = self.weigh_points(xs[remaining], ys[remaining])
+            parts.append((remaining, fresh.stations, fresh.weights))
+        position = np.full(grid.shape(), -1)
+        position[selected] = np.arange(int(selected.sum()))
+        width = max(part[1].shape[1] for part in parts)
+        stations = np.zeros((int(selected.sum()), width), dtype=int)
+        weights = np.zeros((int(selected.sum()), width))
+        for take, rows_stations, rows_weights in parts:
+            stations[position[take], :rows_stations.shape[1]] = rows_stations
+            weights[position[take], :rows_weights.shape[1]] = rows_weights
+        #rows narrower than the widest are padded with weight 0
+        return Stencil(stations, weights)
+
+    def weigh(self, grid, cells=None):
+        "Return a new stencil for the midpoints of the cells of 'grid', or of those selected by 'cells'"
+        xs, ys = grid.midpoints()
+        if cells is not None:
+            return self.weigh_points(xs[cells], ys[cells])
+        return self.weigh_points(xs.ravel(), ys.ravel())
+
+    def weigh_points(self, xs, ys):
+        "Return a new stencil for the points at arrays of longs 'xs' and lats 'ys'"
+        raise NotImplementedError
+
+    def reach(self, box):
+        """
+        Return the sorted indices of the stations whose readings can make up
+        the value interpolated at a point within 'box', a min long, min lat,
+        max long and max lat. The k closest stations to any point of the box
+        are no further from its centre than the k closest stations to the
+        centre, plus the length of the box's diagonal.
+        """
+        MINLONG, MINLAT, MAXLONG, MAXLAT = box
+        x, y = (MINLONG + MAXLONG)/2, (MINLAT + MAXLAT)/2
+        furthest = self.index.nearest(x, y, min(self.k, len(self.index)))[-1]
+        radius = np.hypot(self.index.longs[furthest] - x, self.index.lats[furthest] - y) + np.hypot(MAXLONG - MINLONG,
+        MAXLAT - MINLAT)
+        return np.flatnonzero(np.hypot(self.index.longs - x, self.index.lats - y) <= radius*(1 + 1e-9))
+
+    def interpolate(self, grid, values, cells=None):
+        """
+        Return a rows x cols array of a reading per station interpolated onto
+        'grid'. Given a rows x cols boolean array 'cells', only the cells it
+        selects are interpolated, and the rest are nan.
+        """
+        if cells is None:
+            return self.stencil(grid).apply(values).reshape(grid.shape())
+        field = np.full(grid.shape(), np.nan)
+        if cells.any():
+            field[cells] = self.stencil(grid, cells).apply(values)
+        return field
+
+    def wind(self, grid, cells=None):
+        """
+        Return rows x cols arrays of the wind speed and wind direction
+        interpolated onto 'grid', or onto the cells selected by 'cells'. The
+        u and v components of the winds are interpolated, and turned back
+        into speeds and directions after.
+        """
+        return wind_polar(self.interpolate(grid, self.index.wind_u, cells),
+        self.interpolate(grid, self.index.wind_v, cells))
+
+class NearestMean(Interpolator):
+    """
+    The unweighted mean of the k stations closest to each point, as drawn by
+    Region.temp_and_wind.
+    """
+
+    def weigh_points(self, xs, ys):
+        closest = self.index.nearest_batch(xs, ys, self.k)
+        return Stencil(closest, np.ones(closest.shape))
+
+class InverseDistance(Interpolator):
+    """
+    Inverse distance weighting of the k stations closest to each point, so
+    nearer stations count for more. A point on top of a station takes its
+    readings.
+    """
+    K = 8
+    POWER = 2
+    #weights fall off with distance to this power
+
+    def weigh_points(self, xs, ys):
+        closest = self.index.nearest_batch(xs, ys, self.k)
+        dists = np.hypot(self.index.longs[closest] - xs[:, None], self.index.lats[closest] - ys[:, None])
+        return Stencil(closest, np.maximum(dists, 1e-12)**-InverseDistance.POWER)
+
+class Linear(Interpolator):
+    """
+    Linear interpolation over a Delaunay triangulation of the stations, built
+    once when the interpolator is. Each point takes the barycentric mean of
+    the three corners of the triangle containing it. Points outside every
+    triangle fall back to the mean of their k closest stations. Needs scipy.
+    """
+
+    def __init__(self, index, k=None):
+        super().__init__(index, k)
+        if Delaunay is None:
+            raise ImportError('{} interpolation requires scipy'.format(type(self).__name__))
+        self.points = np.column_stack((index.longs, index.lats))
+        self.triangulation = Delaunay(self.points) if len(index) >= 3 else None
+        self.centres = self.radii = None
+        #circumcircles of the triangles, worked out by circles() when needed
+
+    def circles(self):
+        "Return the circumcentre and squared circumradius of each triangle, worked out once"
+        if self.centres is None:
+            corners = self.points[self.triangulation.simplices]
+            self.centres = circumcentres(corners[:, 0], corners[:, 1], corners[:, 2])
+            self.radii = ((corners[:, 0] - self.centres)**2).sum(axis=1)
+        return self.centres, self.radii
+
+    def locate(self, points):
+        """
+        Return the triangle containing each of an n x 2 array of points, -1
+        outside the triangulation, and the barycentric weights of the
+        triangle's corners
+        """
+        if self.triangulation is None:
+            return np.full(len(points), -1), np.zeros((len(points), 3))
+        simplex = self.triangulation.find_simplex(points)
+        transform = self.triangulation.transform[simplex]
+        b = np.einsum('ijk,ik->ij', transform[:, :2], points - transform[:, 2])
+        return simplex, np.column_stack((b, 1 - b.sum(axis=1)))
+
+    def fallback(self, points, stations, weights, outside):
+        "Fill the rows of 'outside' points with the k closest stations, equally weighted"
+        if outside.any():
+            closest = self.index.nearest_batch(points[outside, 0], points[outside, 1], min(self.k, stations.shape[1]))
+            stations[outside, :closest.shape[1]] = closest
+            weights[outside, :closest.shape[1]] = 1
+
+    def weigh_points(self, xs, ys):
+        points = np.column_stack((xs, ys))
+        simplex, weights = self.locate(points)
+        inside = simplex >= 0
+        stations = np.zeros((len(points), 3), dtype=int)
+        stations[inside] = self.triangulation.simplices[simplex[inside]]
+        weights[~inside] = 0
+        self.fallback(points, stations, weights, ~inside)
+        return Stencil(stations, weights)
+
+    def reach(self, box):
+        """
+        Return the sorted indices of the stations whose readings can make up
+        the value interpolated at a point within 'box': the corners of every
+        triangle whose circumcircle meets the box, as the triangle containing
+        a point, and every triangle whose circumcircle holds it, is one of
+        them, and the closest stations that points outside the triangulation
+        fall back to
+        """
+        near = super().reach(box)
+        if self.triangulation is None:
+            return near
+        MINLONG, MINLAT, MAXLONG, MAXLAT = box
+        centres, radii = self.circles()
+        dx = np.clip(centres[:, 0], MINLONG, MAXLONG) - centres[:, 0]
+        dy = np.clip(centres[:, 1], MINLAT, MAXLAT) - centres[:, 1]
+        return np.union1d(near, self.triangulation.simplices[dx**2 + dy**2 <= radii*(1 + 1e-9)].ravel())
+
+def circumcentres(a, b, c):
+    "Return the circumcentres of the triangles with corners at rows of a, b and c"
+    d = 2*(a[..., 0]*(b[..., 1] - c[..., 1]) + b[..., 0]*(c[..., 1] - a[..., 1]) + c[..., 0]*(a[..., 1] - b[..., 1]))
+    aa, bb, cc = (a**2).sum(axis=-1), (b**2).sum(axis=-1), (c**2).sum(axis=-1)
+    return np.stack(((aa*(b[..., 1] - c[..., 1]) + bb*(c[..., 1] - a[..., 1]) + cc*(a[..., 1] - b[..., 1]))/d,
+    (aa*(c[..., 0] - b[..., 0]) + bb*(a[..., 0] - c[..., 0]) + cc*(b[..., 0] - a[..., 0]))/d), axis=-1)
+
+def unique(keys):
+    "Return the sorted distinct values of an array of integer keys"
+    keys = np.sort(keys)
+    return keys[first(keys)]
+
+def first(keys):
+    "Return a boolean array marking the first of each run of equal values in a sorted array"
+    mask = np.ones(len(keys), dtype=bool)
+    mask[1:] = keys[1:] != keys[:-1]
+    return mask
+
+def signed_area(a, b, c):
+    "Return the signed areas of the triangles with corners at rows of a, b and c, positive if anticlockwise"
+    return ((b[..., 0] - a[..., 0])*(c[..., 1] - a[..., 1]) - (c[..., 0] - a[..., 0])*(b[..., 1] - a[..., 1]))/2
+
+class NaturalNeighbour(Linear):
+    """
+    Sibson's natural neighbour interpolation over the Delaunay triangulation
+    of the stations. Each point is weighted towards the stations whose
+    Voronoi cells would lose area to it if it were added as a station, in
+    proportion to the area lost. The triangles whose circumcircles hold a
+    point are found by walking out from the triangle containing it, and the
+    lost areas are summed from the circumcentres of those triangles, as in
+    Watson's method. The circumcircles are worked out once, with the
+    triangulation. Points outside the triangulation fall back to the mean of
+    their k closest stations. Needs scipy.
+    """
+
+    def __init__(self, index, k=None):
+        super().__init__(index, k)
+        if self.triangulation is not None:
+            self.circles()
+            corners = self.points[self.triangulation.simplices]
+            self.orientation = np.sign(signed_area(corners[:, 0], corners[:, 1], corners[:, 2]))
+
+    def cavities(self, points, simplex):
+        """
+        Return parallel arrays of point numbers and triangles, holding every
+        triangle whose circumcircle contains each point, starting from the
+        triangle 'simplex' that contains it
+        """
+        ntri = len(self.triangulation.simplices)
+        q = np.flatnonzero(simplex >= 0)
+        t = simplex[q]
+        found = [q.astype(np.int64)*ntri + t]
+        before = np.empty(0, dtype=np.int64)
+        while len(q):
+            nq = np.repeat(q, 3)
+            nt = self.triangulation.neighbors[t].ravel()
+            ok = nt >= 0
+            nq, nt = nq[ok], nt[ok]
+            ok = ((points[nq] - self.centres[nt])**2).sum(axis=1) < self.radii[nt]
+            keys = unique(nq[ok].astype(np.int64)*ntri + nt[ok])
+            known = np.sort(np.concatenate((before, found[-1])))
+            keys = keys[known[np.minimum(np.searchsorted(known, keys), len(known) - 1)] != keys]
+            #the neighbours of the last triangles found are either new or were
+            #found in one of the last two steps of the walk
+            before = found[-1]
+            q, t = keys // ntri, keys % ntri
+            found.append(keys)
+        keys = np.concatenate(found)
+        return keys // ntri, keys % ntri
+
+    def weigh_points(self, xs, ys):
+        points = np.column_stack((xs, ys))
+        simplex, barycentric = self.locate(points)
+        inside = simplex >= 0
+        if not inside.any():
+            stations, weights = np.zeros((len(points), 3), dtype=int), np.zeros((len(points), 3))
+            self.fallback(points, stations, weights, ~inside)
+            return Stencil(stations, weights)
+        q, t = self.cavities(points, simplex)
+        corners = self.triangulation.simplices[t]
+        rel = self.points[corners] - points[q, None, :]
+        #corners relative to the point, which is the origin below
+        x, y = rel[..., 0], rel[..., 1]
+        rr = x**2 + y**2
+        x1, y1, rr1 = np.roll(x, -1, axis=1), np.roll(y, -1, axis=1), np.roll(rr, -1, axis=1)
+        d = 2*(x*y1 - x1*y)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            #a point on top of a station has no circumcentre with it, and is
+            #given linear weights below
+            g = np.stack(((rr*y1 - rr1*y)/d, (rr1*x - rr*x1)/d), axis=-1)
+            #g[:, i] is the circumcentre of the point and the edge from corner i to corner i+1
+            centre = self.centres[t] - points[q]
+            area = np.stack([signed_area(g[:, (i + 2) % 3], g[:, i], centre) for i in range(3)], axis=1)
+            area *= self.orientation[t, None]
+        #the area corner i loses to the point within this triangle
+        stations = corners.ravel()
+        owner = np.repeat(q, 3)
+        keys = owner.astype(np.int64)*len(self.index) + stations
+        order = np.argsort(keys)
+        keys = keys[order]
+        runs = first(keys)
+        area = np.add.reduceat(area.ravel()[order], np.flatnonzero(runs))
+        keys = keys[runs]
+        owner, stations = keys // len(self.index), keys % len(self.index)
+        #a station shared by several triangles appears once per point
+        starts = np.searchsorted(owner, np.arange(len(points)))
+        slot = np.arange(len(keys)) - starts[owner]
+        width = max(int(slot.max()) + 1, 3)
+        dense_stations = np.zeros((len(points), width), dtype=int)
+        weights = np.zeros((len(points), width))
+        dense_stations[owner, slot] = stations
+        weights[owner, slot] = area
+        bad = inside & ~(np.isfinite(weights).all(axis=1) & (weights.sum(axis=1) > 0))
+        #a point on top of a station, or on a circumcircle, takes linear weights
+        dense_stations[bad] = 0
+        weights[bad] = 0
+        dense_stations[bad, :3] = self.triangulation.simplices[simplex[bad]]
+        weights[bad, :3] = barycentric[bad]
+        self.fallback(points, dense_stations, weights, ~inside)
+        return Stencil(dense_stations, weights)
+
+ENGINES = {'nearest': NearestMean, 'idw': InverseDistance, 'linear': Linear, 'natural': NaturalNeighbour}
+#interpolators by the name they are chosen with
+
+def interpolator(name, index, k=None):
+    '''
+    Returns the interpolator called 'name' in ENGINES built over the
+    StationIndex 'index'
+    '''
+    if name not in ENGINES:
+        raise ValueError('unknown interpolation {!r}, expected one of {}'.format(name, ', '.join(ENGINES)))
+    return ENGINES[name](index, k)
@@ -1,12 +1,19 @@
-import sys
-import csv
-import math
+import os
 import re
+import functools
+import argparse
 import PIL.ImageColor
-import requests
-import io
+import metar
+import instrument
+import outputs as encoders
 from region import Region
 from region import Point
+from region import Grid
+from boundaries import load_boundaries
+from boundaries import source_stamp
+from stations import StationIndex
+from stations import SampleCache
+import interpolation as engines
 from plot import Plot
 from PIL import Image, ImageDraw
 
@@ -15,7 +22,7 @@ STATES = ['Alabama','Arizona','Arkansas','California','Colorado','Connecticut','
 'Maine','Maryland','Massachusetts','Michigan','Minnesota','Mississippi','Missouri',
 'Montana','Nebraska','Nevada','New_Hampshire','New_Jersey','New_Mexico','New_York',
 'North_Carolina','North_Dakota','Ohio','Oklahoma','Oregon','Pennsylvania',
-'Rhode_Island','South_Carolina','South_Dakota','Tennessee','Texas','Utah','Vermont'
+'Rhode_Island','South_Carolina','South_Dakota','Tennessee','Texas','Utah','Vermont',
 'Virginia','Washington','West_Virginia','Wisconsin','Wyoming']
 
 REGIONS = {'New_England':['Massachusetts','Connecticut', 'Rhode_Island','Maine',
@@ -42,19 +49,28 @@ COLORS = {-30 : '#5700FF', -29 : '#5700FF', -28 : '#5700FF', -27 : '#5700FF', -2
 
 URL = 'http://aviationweather.gov/adds/dataserver_current/current/metars.cache.csv'
 
-def mercator(lat):
-    """project latitude 'lat' according to Mercator"""
-    lat_rad = (lat * math.pi) / 180
-    projection = math.log(math.tan((math.pi / 4) + (lat_rad / 2)))
-    return (180 * projection) / math.pi
+BOUNDARIES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'states.csv')
+#boundary file used by draw_section and render_bytes unless they are given another
 
-def grid(minlong, maxlong, minlat, maxlat, wind=True):
+LAYOUTS = 64
+#number of section layouts kept in memory by section_layout
+
+SNAPSHOTS = 4
+#number of snapshots whose interpolators are kept in memory by snapshot_interpolator
+
+def grid(minlong, maxlong, minlat, maxlat, wind=True, cells=None):
     '''
     Partitions area given by long and lat values into X*Y rectangles of uniform size.
     A coarser grid is used when plotting wind values in order to avoid visual clutter.
+    If cells is given, the area is partitioned into cells*cells rectangles instead.
 
     '''
-    if wind:
+    if cells:
+        X = cells
+        Y = cells
+        VALX = (maxlong-minlong)/X
+        VALY = (maxlat-minlat)/Y
+    elif wind:
         X = 20
         Y = 20
         VALX = (maxlong-minlong)/X
@@ -119,7 +135,305 @@ def time_and_date(tdstr):
     date = '{}-{}-{}'.format(datestr[0][1],dateint,datestr[0][0][2:])
     time = '{}:{} EST'.format(timeEST,timestr[0][1])
     return '{} {}'.format(time,date)
-def main(boundaries, output, section=None, filename = 'metars.cache.csv'):
+def section_regions(boundaries, section):
+    """
+    Returns the name of the section to be plotted and a list of Regions of the
+    boundaries of the states within it.
+    Args:
+        boundaries (str): name of a csv file of geographic information
+        section: area of US that the user wishes to map
+    """
+    if section in STATES:
+        names = [section]
+    elif section in REGIONS:
+        names = REGIONS[section]
+    else:
+        names = None
+        section = 'USA'
+    #section is compared to key values in both STATES and REGIONS
+    #if it is not in either, the entire US is plotted
+    regions=[Region(coords.tolist()) for coords in load_boundaries(boundaries, names)]
+    #boundaries are read from a pre-projected binary cache of the csv file,
+    #which is rebuilt whenever the csv file changes
+    return section, regions
+
+def bounding_box(regions):
+    """
+    Returns the min long, min lat, max long and max lat of a list of Regions
+    """
+    return (min([r.min_long() for r in regions]), min([r.min_lat() for r in regions]),
+    max([r.max_long() for r in regions]), max([r.max_lat() for r in regions]))
+
+def fetch_stations(location=URL, cache=None):
+    """
+    Returns a metar.Snapshot of the stations with valid long, lat, temp, wind
+    speed and wind direction values, with lats converted to mercator form.
+    The data is parsed as it is read rather than loaded whole.
+    Args:
+        location: URL or csv file name of the METAR data, or a source object
+        from metar.py
+        cache (SnapshotCache): on-disk cache that URLs are fetched through
+    """
+    source = metar.source(location)
+    if cache is not None and isinstance(source, metar.HTTPSource):
+        return cache.fetch(source.url)
+    return metar.parse(source.lines())
+
+class Layout:
+    """
+    Everything about drawing a section that does not depend on the weather:
+    its Regions, their bounding box, the temperature and wind grids over it,
+    the midpoints of the wind cells, and the pixel spans of the grid cells at
+    each width drawn, which are shared by every Plot made from the layout.
+    """
+
+    def __init__(self, regions, section, resolution=70, wind_resolution=20):
+        self.regions = regions
+        self.section = section
+        self.bounds = bounding_box(regions)
+        MINLONG, MINLAT, MAXLONG, MAXLAT = self.bounds
+        self.grid = Grid(MINLONG,MAXLONG,MINLAT,MAXLAT,resolution,resolution)
+        self.wind_grid = Grid(MINLONG,MAXLONG,MINLAT,MAXLAT,wind_resolution,wind_resolution)
+        self.wind_points = self.wind_grid.midpoints()
+        self.pixels = {}
+
+    def __repr__(self):
+        return "Layout({}, {}x{}, {}x{})".format(self.section, self.grid.cols, self.grid.rows,
+        self.wind_grid.cols, self.wind_grid.rows)
+
+    def plot(self, width=Plot.WIDTH):
+        """
+        Return a new Plot of the section with a blank image 'width' pixels
+        wide, with its legend, glyphs and borders scaled to match
+        """
+        scale = width/Plot.WIDTH
+        return Plot(*self.bounds, width, round(Plot.LEGEND*scale), self.pixels.setdefault(width, {}), scale)
+
+    def size(self, width=Plot.WIDTH):
+        "Return the width and height of the image of a Plot of the section 'width' pixels wide"
+        MINLONG, MINLAT, MAXLONG, MAXLAT = self.bounds
+        return width, Plot.proportional_height(width, MAXLONG - MINLONG, MAXLAT - MINLAT) + round(Plot.LEGEND*width/Plot.WIDTH)
+
+    def drawing_width(self, outputs):
+        """
+        Return the width to draw the section at for the outputs.Output list
+        'outputs': that of the largest output, so every output is resampled
+        down from the drawing and never up, but no less than Plot.WIDTH
+        """
+        return max([Plot.WIDTH] + [output.size(self.size())[0] for output in outputs])
+
+@functools.lru_cache(maxsize=LAYOUTS)
+def cached_layout(boundaries, stamp, section, resolution, wind_resolution):
+    "Return a new Layout, kept by section_layout in an LRU cache keyed by its arguments"
+    name, regions = section_regions(boundaries, section)
+    return Layout(regions, name, resolution, wind_resolution)
+
+def section_layout(boundaries, section=None, resolution=70, wind_resolution=20):
+    """
+    Returns the Layout of 'section' from the boundary csv file 'boundaries'.
+    The LAYOUTS layouts used most recently are kept in memory, so drawing a
+    popular section again skips loading and projecting its boundaries and
+    building its grids. A layout is built again if the boundary file has
+    changed since it was kept.
+    """
+    if section not in STATES and section not in REGIONS:
+        section = None
+    #every other name is drawn as the whole US, so they share one layout
+    stamp = tuple(sorted(source_stamp(boundaries).items()))
+    return cached_layout(os.path.abspath(boundaries), stamp, section, resolution, wind_resolution)
+
+@functools.lru_cache(maxsize=SNAPSHOTS)
+def snapshot_interpolator(stations, interpolation='nearest'):
+    """
+    Returns an interpolator of the Snapshot 'stations', kept for the
+    SNAPSHOTS snapshots used most recently, so that every section drawn
+    from the same snapshot shares its index and stencils
+    """
+    return engines.interpolator(interpolation, StationIndex.from_snapshot(stations))
+
+def draw_section(section=None, stations=None, boundaries=BOUNDARIES, location=URL, cache=None, **options):
+    """
+    Draws an image of a section and returns it as a PIL Image, for use as a
+    library. The section's layout comes from the cache of section_layout.
+    Args:
+        section: area of US to draw, the whole US if not a state or region
+        stations (Snapshot): stations that have already been parsed, such as
+        a metar.Snapshot from fetch_stations or metar.parse; fetched from
+        location if not given
+        boundaries (str): name of a csv file of geographic information,
+        by default the states.csv file next to this module
+        location: URL or csv file name of the METAR data, or a source object
+        from metar.py, used when stations is not given
+        cache (SnapshotCache): on-disk cache that URLs are fetched through
+        options: keyword arguments passed on to draw. The interpolator of
+        the stations comes from snapshot_interpolator unless one is given.
+    """
+    layout = section_layout(boundaries, section, options.pop('resolution', 70), options.pop('wind_resolution', 20))
+    if stations is None:
+        stations = fetch_stations(location, cache)
+    if options.get('interpolator') is None:
+        options['interpolator'] = snapshot_interpolator(stations, options.pop('interpolation', 'nearest'))
+    return draw(layout.regions, layout.section, stations, layout=layout, **options)
+
+def render_bytes(section=None, stations=None, format='PNG', width=None, height=None, fast=False, **options):
+    """
+    Draws an image of a section as draw_section does, and returns it encoded
+    as bytes in the given PIL format, such as 'PNG', 'JPEG' or 'WEBP',
+    sized to width and height as outputs.Output is. A size larger than the
+    usual width is drawn at that size rather than resampled up. With fast,
+    the image is encoded with the quicker settings of outputs.FAST.
+    """
+    output = encoders.Output(None, width, height, format, fast)
+    layout = section_layout(options.get('boundaries', BOUNDARIES), section, options.get('resolution', 70),
+    options.get('wind_resolution', 20))
+    #the layout draw_section draws from, kept by section_layout
+    image = draw_section(section, stations, width=layout.drawing_width([output]), **options)
+    return output.encode(image)
+
+def render(regions, section, stations, output, threads=None, fast=False, **options):
+    """
+    Draws an image of a section from stations that have already been fetched and
+    saves it to output. The image is drawn once, at the size of the largest
+    output, and each output it is saved to is resampled down and encoded
+    from it in a thread of its own. Outputs without a size are saved at the
+    usual size of the map, Plot.WIDTH pixels wide.
+    Args:
+        regions (list): Regions of the boundaries in the section
+        section (str): name of the section, as returned by section_regions
+        stations (Snapshot): stations as returned by fetch_stations
+        output: name of a file to save the image, which may end with a size
+        as in map.webp:512 (see outputs.Output.parse), an outputs.Output, or
+        a list of them
+        threads (int): number of threads encoding the outputs
+        fast (bool): encode with the quicker settings of outputs.FAST
+        options: keyword arguments passed on to draw
+    """
+    targets = encoders.outputs(output, fast)
+    layout = options.pop('layout', None)
+    if layout is None:
+        with instrument.stage('layout'):
+            layout = Layout(regions, section, options.pop('resolution', 70), options.pop('wind_resolution', 20))
+    image = draw(regions, section, stations, layout=layout, width=layout.drawing_width(targets), **options)
+    with instrument.stage('encode'):
+        encoders.save_all(image, targets, threads, default=layout.size())
+
+def draw(regions, section, stations, index=None, vectorized=True, resolution=70,
+    wind_resolution=20, interpolation='nearest', interpolator=None, glyphs='arrows', clip=False,
+    transparent=False, layout=None, width=Plot.WIDTH):
+    """
+    Draws an image of a section from stations that have already been fetched and
+    returns it as a PIL Image.
+    Args:
+        regions (list): Regions of the boundaries in the section
+        section (str): name of the section, as returned by section_regions
+        stations (Snapshot): stations as returned by fetch_stations
+        index (StationIndex): index of stations, built here if not given
+        vectorized (bool): grid and interpolate with arrays in one batch rather
+        than with a Region per cell
+        resolution (int): number of rows and columns in the temperature grid
+        wind_resolution (int): number of rows and columns in the wind grid
+        interpolation (str): name of the interpolator in interpolation.ENGINES
+        used by the vectorized path
+        interpolator (Interpolator): interpolator of the stations, built here
+        if not given
+        glyphs (str): 'arrows' to draw wind as arrows, or 'barbs' to draw
+        standard wind barbs
+        clip (bool): only interpolate and draw the cells inside the boundaries
+        of the section, found from a cached mask of them, rather than every
+        cell of the bounding box. Used by the vectorized path.
+        transparent (bool): leave the map transparent rather than white where
+        nothing is drawn, such as outside the section when clipping
+        layout (Layout): layout of the section and resolutions, such as one
+        from section_layout, built here if not given
+        width (int): width of the image in pixels, with the legend, wind
+        glyphs and borders scaled from their size at Plot.WIDTH
+    """
+    if layout is None:
+        with instrument.stage('layout'):
+            layout = Layout(regions, section, resolution, wind_resolution)
+    MINLONG, MINLAT, MAXLONG, MAXLAT = layout.bounds
+    p = layout.plot(width)
+    if transparent:
+        p.image = Image.new('RGBA', p.image.size, (0, 0, 0, 0))
+        #the legend is pasted on as an opaque layer below the map
+    if vectorized:
+        g = layout.grid
+        h = layout.wind_grid
+    else:
+        with instrument.stage('grid'):
+            g = grid(MINLONG,MAXLONG,MINLAT,MAXLAT,False,layout.grid.cols)
+            h = grid(MINLONG,MAXLONG,MINLAT,MAXLAT,True,layout.wind_grid.cols)
+    #g is grid to be used for temperature plotting
+    #h is coarser grid to be used for wind plotting
+    if interpolator is not None:
+        index = interpolator.index
+    if index is None:
+        with instrument.stage('index'):
+            index = StationIndex.from_snapshot(stations)
+    #spatial index of the stations used for nearest station lookups
+    timedate = time_and_date(stations.timestamp())
+    #time and date for the data from each station are relatively consistent
+    #across all stations; thus the latest observation time is used
+    if vectorized:
+        if interpolator is None:
+            with instrument.stage('index'):
+                interpolator = engines.interpolator(interpolation, index)
+        cells = wind_cells = mask = None
+        xs, ys = layout.wind_points
+        if clip:
+            with instrument.stage('mask'):
+                mask = p.section_mask(regions, section)
+                cells = p.section_cells(regions, section, g)
+                wind_cells = p.section_points(regions, section, xs, ys)
+            #cells of g touching the section, and cells of h centred inside it
+        with instrument.stage('interpolate'):
+            temps = interpolator.interpolate(g, index.temps, cells)
+            #temp values of every square in g from a single batched query
+            w_speeds, w_directions = interpolator.wind(h, wind_cells)
+        instrument.count('cells_interpolated', (len(g) if cells is None else int(cells.sum())) +
+        (len(h) if wind_cells is None else int(wind_cells.sum())))
+        with instrument.stage('rasterize'):
+            p.draw_field(g, temps, COLORS, cells, mask)
+        if clip:
+            xs, ys, w_speeds, w_directions = xs[wind_cells], ys[wind_cells], w_speeds[wind_cells], w_directions[wind_cells]
+        with instrument.stage('wind_glyphs'):
+            if glyphs == 'barbs':
+                p.draw_barbs(xs, ys, w_speeds, w_directions, 'BLACK')
+            else:
+                p.draw_arrows(xs, ys, w_speeds, w_directions, 'BLACK', 1)
+        #every wind glyph is drawn in one batch
+    else:
+        samples = SampleCache(index)
+        #readings already interpolated, shared by the temperature and wind grids
+        instrument.count('cells_interpolated', len(g) + len(h))
+        for square in g:
+            with instrument.stage('interpolate'):
+                t=int(square.temp_and_wind(samples)[0])
+            #temp value of square
+            #t is cast to an int to yield closest color value for temperature
+            #value in COLORS
+            with instrument.stage('rasterize'):
+                p.draw(square, COLORS[t])
+        for windsquare in h:
+            #arrows are drawn with respect to their wind speed and direction,
+            #with color black and width of 1 used for visibility purposes
+            with instrument.stage('interpolate'):
+                w_speed, w_direction = windsquare.temp_and_wind(samples)[1:]
+            with instrument.stage('wind_glyphs'):
+                if glyphs == 'barbs':
+                    x, y = windsquare.midpoint()
+                    p.draw_barbs([x], [y], [w_speed], [w_direction], 'BLACK')
+                else:
+                    p.draw_arrow(windsquare, w_speed, w_direction, 'BLACK', 1)
+    with instrument.stage('borders'):
+        p.draw_borders(regions, section)
+    with instrument.stage('legend'):
+        p.draw_legend(section,timedate, COLORS, glyphs)
+    return p.image
+
+def main(boundaries, output, section=None, filename = 'metars.cache.csv', vectorized=True,
+    resolution=70, wind_resolution=20, location=URL, cachedir='metar_cache', max_age=300,
+    interpolation='nearest', glyphs='arrows', clip=False, transparent=False, threads=None, fast=False):
     """
     Draws an image.
     This function creates an image object, constructs Region objects by reading
@@ -128,97 +442,56 @@ def main(boundaries, output, section=None, filename = 'metars.cache.csv'):
     and speed.
     Args:
         boundaries (str): name of a csv file of geographic information
-        output (str): name of a file to save the image
+        output: name of a file to save the image, or a list of them, each of
+        which may end with a size such as :512 or :800x600 to save the image
+        resampled to that size, in the format of the file's extension
         section: area of US that the user wishes to map
-        filename: name of file to draw weather data from
-    """
-    def to_point(lst):
-        '''
-        creates a list of tuples from a line of lat / lon values and converts to mercator
-        '''
-        coords = []
-        i=2
-        j=3
-        while i<len(lst) and j<len(lst):
-            coords.append([float(lst[i]),mercator(float(lst[j]))])
-            i+=2
-            j+=2
-        return coords
-
-    with open(boundaries, 'r') as fin2:
-        parsedfin2 = list(csv.reader(fin2))
-        boundarylist = []
-        #section is compared to key values in both STATES and REGIONS
-        #if it is not in either, the entire US is plotted
-        if section in STATES:
-            for row in parsedfin2:
-                if row[0] == section:
-                    boundarylist.append(to_point(row))
-        elif section in REGIONS:
-            for state in REGIONS[section]:
-                for row in parsedfin2:
-                    if row[0] == state:
-                        boundarylist.append(to_point(row))
-        else:
-            for row in parsedfin2:
-                boundarylist.append(to_point(row))
-            section = 'USA'
-        regions=[Region(coords) for coords in boundarylist]
-    MINLONG=min([r.min_long() for r in regions])
-    MAXLONG=max([r.max_long() for r in regions])
-    MINLAT=min([r.min_lat() for r in regions])
-    MAXLAT=max([r.max_lat() for r in regions])
-    p = Plot(MINLONG, MINLAT, MAXLONG, MAXLAT)
-    g = grid(MINLONG,MAXLONG,MINLAT,MAXLAT,False)
-    #g is grid to be used for temperature plotting
-    h=grid(MINLONG,MAXLONG,MINLAT,MAXLAT)
-    #h is coarser grid to be used for wind plotting
-    r = requests.get(URL)
-    #retrieving the weather data file
-    parsedfin = list(csv.reader(io.StringIO(r.text)))
-    #converting the weather data into an iterable format
-    unsorted = []
-    for line in parsedfin[6:]:
-    #Some rows in file do not yield proper values. Removing stations
-    #from consideration set that do not have proper long, lat, temp,
-    #wind speed, or wind direction values.
-        try:
-            float(line[8])
-            float(line[7])
-            float(line[5])
-            float(line[4])
-            float(line[3])
-            unsorted.append(line)
-        except ValueError as b:
-            continue
-    for c in unsorted:
-    #modifying all latitude values into mercator form
-        c[3] = mercator(float(c[3]))
-    stations = sorted(unsorted, key=lambda row: float(row[4]), reverse = True)
-    #sorting list of stations by longitude to improve efficiency
-    timedate = time_and_date(stations[1][2])
-    #time and date for the data from each station are relatively consistent
-    #across all stations; thus the values from a station near the start of the
-    #list are used
-    for square in g:
-        t=int(square.temp_and_wind(stations)[0])
-        #temp value of square
-        #t is cast to an int to yield closest color value for temperature
-        #value in COLORS
-        p.draw(square, COLORS[t])
-    for windsquare in h:
-        #arrows are drawn with respect to their wind speed and direction,
-        #with color black and width of 1 used for visibility purposes
-        w_speed = windsquare.temp_and_wind(stations)[1]
-        w_direction = windsquare.temp_and_wind(stations)[2]
-        p.draw_arrow(windsquare, w_speed, w_direction, 'BLACK', 1)
-    for r in regions:
-        p.draw(r, None, border=(0,0,0))
-    p.draw_legend(section,timedate, COLORS)
-    p.save(output)
+        filename: name of the file the weather data is kept in within cachedir
+        vectorized (bool): grid and interpolate with arrays in one batch rather
+        than with a Region per cell
+        resolution (int): number of rows and columns in the temperature grid
+        wind_resolution (int): number of rows and columns in the wind grid
+        location: URL or csv file name of the METAR data, or a source object
+        from metar.py
+        cachedir (str): directory that weather data downloaded from a URL is
+        kept in, or None to download it every time
+        max_age (float): seconds that downloaded weather data is reused for
+        before checking the URL for newer data
+        interpolation (str): name of the interpolator in interpolation.ENGINES,
+        one of nearest, idw, linear and natural
+        glyphs (str): 'arrows' to draw wind as arrows, or 'barbs' to draw
+        standard wind barbs
+        clip (bool): only interpolate and draw inside the section's boundaries
+        transparent (bool): leave the map transparent where nothing is drawn
+        threads (int): number of threads encoding the outputs
+        fast (bool): encode with the quicker settings of outputs.FAST
+    """
+    with instrument.stage('boundaries'):
+        section, regions = section_regions(boundaries, section)
+    cache = metar.SnapshotCache(cachedir, max_age, filename) if cachedir else None
+    with instrument.stage('fetch'):
+        stations = fetch_stations(location, cache)
+    render(regions, section, stations, output, threads, fast, vectorized=vectorized, resolution=resolution,
+    wind_resolution=wind_resolution, interpolation=interpolation, glyphs=glyphs, clip=clip, transparent=transparent)
 
 if __name__ == '__main__':
-    boundaries = sys.argv[1]
-    output = sys.argv[2]
-    section = sys.argv[3]
-    main(boundaries, output, section)
+    parser = argparse.ArgumentParser(description='Draw a map of current temperature and wind.')
+    parser.add_argument('boundaries', help='csv file of state boundaries (ex: states.csv)')
+    parser.add_argument('output', help='file to save the image in, optionally ending in a size such as :800x600')
+    parser.add_argument('section', nargs='?', default=None, help='section to plot (default: USA)')
+    parser.add_argument('--also', action='append', default=[], metavar='OUTPUT',
+    help='another file to save the image in, such as thumb.jpg:256 or map.webp:2048; may be repeated')
+    parser.add_argument('--threads', type=int, default=None, help='number of threads encoding the outputs')
+    parser.add_argument('--fast', action='store_true', help='encode faster, into larger files')
+    parser.add_argument('--report', help="json file to save a report of each stage's time and counts in, or - to print it")
+    parser.add_argument('--profile', help='file to save cProfile statistics of the run in, to be read with pstats')
+    args = parser.parse_args()
+    if args.report or args.profile:
+        with instrument.recording(args.profile) as report:
+            main(args.boundaries, [args.output] + args.also, args.section, threads=args.threads, fast=args.fast)
+        if args.report == '-':
+            print(report.format())
+        elif args.report:
+            report.save(args.report)
+    else:
+        main(args.boundaries, [args.output] + args.also, args.section, threads=args.threads, fast=args.fast)
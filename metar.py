@@ -0,0 +1,268 @@
+import os
+import io
+import csv
+import gzip
+import json
+import time
+import hashlib
+from array import array
+import numpy as np
+import requests
+import instrument
+from region import mercator
+
+COLUMNS = ('station_id', 'observation_time', 'latitude', 'longitude', 'temp_c', 'wind_dir_degrees',
+'wind_speed_kt')
+#columns of the METAR csv layout that are read, located by name in its header row
+
+TIMEOUT = 30
+#seconds to wait for the server before a request fails
+
+_session = None
+
+def session():
+    "Return a requests session shared by every request, so connections are reused"
+    global _session
+    if _session is None:
+        _session = requests.Session()
+    return _session
+
+def text_lines(stream):
+    '''
+    Yields the lines of a binary stream of utf-8 text one at a time,
+    decompressing the stream as it is read if it is gzip-compressed.
+    '''
+    stream = io.BufferedReader(stream) if not hasattr(stream, 'peek') else stream
+    if stream.peek(2)[:2] == b'\x1f\x8b':
+        stream = gzip.GzipFile(fileobj=stream)
+    yield from io.TextIOWrapper(stream, encoding='utf-8', newline='')
+
+class Snapshot:
+    """
+    The stations of one METAR snapshot as parallel arrays: station ids,
+    observation times, longs, mercator lats, temperatures (C), wind speeds (kt)
+    and wind directions (degrees).
+    """
+
+    def __init__(self, station_ids, times, longs, lats, temps, wind_speeds, wind_directions):
+        self.station_ids = np.asarray(station_ids, dtype=str)
+        self.times = np.asarray(times).astype('datetime64[s]')
+        self.longs = np.asarray(longs, dtype=float)
+        self.lats = np.asarray(lats, dtype=float)
+        self.temps = np.asarray(temps, dtype=float)
+        self.wind_speeds = np.asarray(wind_speeds, dtype=float)
+        self.wind_directions = np.asarray(wind_directions, dtype=float)
+
+    def __len__(self):
+        return len(self.longs)
+
+    def __repr__(self):
+        return "Snapshot({} stations)".format(len(self))
+
+    def save(self, path):
+        "Save the arrays of the snapshot to the npz file 'path'"
+        with open(path, 'wb') as fout:
+            np.savez(fout, station_ids=self.station_ids, times=self.times, longs=self.longs,
+            lats=self.lats, temps=self.temps, wind_speeds=self.wind_speeds,
+            wind_directions=self.wind_directions)
+
+    @classmethod
+    def load(cls, path):
+        "Return the snapshot saved to the npz file 'path'"
+        with np.load(path, allow_pickle=False) as data:
+            return cls(data['station_ids'], data['times'], data['longs'], data['lats'], data['temps'],
+            data['wind_speeds'], data['wind_directions'])
+
+    def timestamp(self):
+        "Return the latest observation time in the format 'YYYY-MM-DDTHH:MM:SSZ'"
+        return str(self.times.max()) + 'Z'
+
+class FileSource:
+    """
+    METAR data read from a local csv file in the aviationweather.gov layout,
+    which may be gzip-compressed.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def __repr__(self):
+        return "FileSource({!r})".format(self.path)
+
+    def lines(self):
+        "Yield the lines of the file one at a time"
+        with open(self.path, 'rb') as fin:
+            yield from text_lines(fin)
+
+class HTTPSource:
+    """
+    METAR data downloaded from a URL serving a csv file in the
+    aviationweather.gov layout, such as the live feed or a local stand-in.
+    The body may be gzip-compressed.
+    """
+
+    def __init__(self, url, timeout=TIMEOUT):
+        self.url = url
+        self.timeout = timeout
+
+    def __repr__(self):
+        return "HTTPSource({!r})".format(self.url)
+
+    def lines(self):
+        "Yield the lines of the response body as they are downloaded"
+        with session().get(self.url, stream=True, timeout=self.timeout) as r:
+            r.raise_for_status()
+            r.raw.decode_content = True
+            r.raw.auto_close = False
+            #left open at the end of the body so buffered readers can finish
+            yield from text_lines(r.raw)
+
+def source(location):
+    '''
+    Returns a METAR source for 'location', which is either a URL, a path to a
+    local csv file, or an object that already has a lines() method.
+    '''
+    if hasattr(location, 'lines'):
+        return location
+    if location.startswith('http://') or location.startswith('https://'):
+        return HTTPSource(location)
+    return FileSource(location)
+
+def parse(lines):
+    '''
+    Returns a Snapshot of the stations in an iterable of lines of METAR csv
+    data, read one row at a time. Rows are located by the header row naming
+    the columns in COLUMNS; any preamble before it is skipped. Stations
+    without a valid long, lat, temp, wind speed or wind direction value are
+    left out.
+    '''
+    reader = csv.reader(lines)
+    for header in reader:
+        if all(name in header for name in COLUMNS):
+            break
+    else:
+        return Snapshot([], [], [], [], [], [], [])
+    #the header row is the first row that names every column that is read
+    ID, TIME, LAT, LONG, TEMP, DIRECTION, SPEED = [header.index(name) for name in COLUMNS]
+    station_ids = []
+    times = array('q')
+    longs = array('d')
+    lats = array('d')
+    temps = array('d')
+    wind_speeds = array('d')
+    wind_directions = array('d')
+    for row in reader:
+        try:
+            values = (float(row[LONG]), mercator(float(row[LAT])), float(row[TEMP]),
+            float(row[SPEED]), float(row[DIRECTION]), np.datetime64(row[TIME].rstrip('Z'), 's'))
+        except (ValueError, IndexError):
+            continue
+        #each value is converted exactly once, and rows with a missing or
+        #invalid value are skipped before anything is stored
+        station_ids.append(row[ID])
+        times.append(values[5].astype(np.int64))
+        longs.append(values[0])
+        lats.append(values[1])
+        temps.append(values[2])
+        wind_speeds.append(values[3])
+        wind_directions.append(values[4])
+    return Snapshot(station_ids, times, longs, lats, temps, wind_speeds, wind_directions)
+
+class SnapshotCache:
+    """
+    Snapshots of METAR feeds kept on disk, keyed by URL. Each feed's last
+    good response is stored as downloaded, next to a parsed copy and the
+    validators the server sent with it. A snapshot younger than max_age
+    seconds is reused without any network I/O; an older one is revalidated
+    with If-None-Match/If-Modified-Since, and is still used if the request
+    fails or the response holds no stations.
+    """
+
+    def __init__(self, directory='metar_cache', max_age=300, filename='metars.cache.csv',
+        timeout=TIMEOUT):
+        self.directory = directory
+        self.max_age = max_age
+        self.filename = filename
+        self.timeout = timeout
+
+    def __repr__(self):
+        return "SnapshotCache({!r})".format(self.directory)
+
+    def paths(self, url):
+        '''
+        Returns the paths of the downloaded body, its parsed snapshot and its
+        metadata for the feed at 'url'
+        '''
+        key = hashlib.sha1(url.encode('utf-8')).hexdigest()[:16]
+        body = os.path.join(self.directory, '{}-{}'.format(key, self.filename))
+        return body, body + '.npz', body + '.json'
+
+    def cached(self, url):
+        '''
+        Returns the metadata and parsed snapshot stored for 'url', or None and
+        None if there are none
+        '''
+        body, parsed, metapath = self.paths(url)
+        try:
+            with open(metapath, 'r') as fin:
+                meta = json.load(fin)
+            return meta, Snapshot.load(parsed)
+        except (OSError, ValueError, KeyError):
+            return None, None
+
+    def fetch(self, url):
+        """
+        Returns a Snapshot of the feed at 'url', downloading and parsing it
+        only if the stored snapshot is older than max_age and the server has
+        a newer one. Raises ValueError if there is no stored snapshot and the
+        response holds no stations.
+        """
+        meta, snapshot = self.cached(url)
+        if snapshot is not None and time.time() - meta['fetched'] < self.max_age:
+            return snapshot
+        headers = {}
+        if snapshot is not None:
+            if meta.get('etag'):
+                headers['If-None-Match'] = meta['etag']
+            if meta.get('last_modified'):
+                headers['If-Modified-Since'] = meta['last_modified']
+        body, parsed, metapath = self.paths(url)
+        try:
+            with instrument.stage('download'), session().get(url, headers=headers, stream=True,
+                timeout=self.timeout) as r:
+                if r.status_code == 304 and snapshot is not None:
+                    meta['fetched'] = time.time()
+                    self.write_meta(metapath, meta)
+                    return snapshot
+                r.raise_for_status()
+                os.makedirs(self.directory, exist_ok=True)
+                with open(body + '.tmp', 'wb') as fout:
+                    for chunk in r.iter_content(65536):
+                        fout.write(chunk)
+                #the body is streamed to disk, and any content-encoding removed
+                validators = {'etag': r.headers.get('ETag'), 'last_modified': r.headers.get('Last-Modified')}
+        except requests.RequestException:
+            if snapshot is not None:
+                return snapshot
+            raise
+        #the last good snapshot stands in for a feed that cannot be reached
+        with instrument.stage('parse'):
+            fresh = parse(FileSource(body + '.tmp').lines())
+        if len(fresh) == 0:
+            os.remove(body + '.tmp')
+            if snapshot is not None:
+                return snapshot
+            raise ValueError('no stations found in the METAR feed at {}'.format(url))
+        #a body without stations, such as a maintenance page, counts as a failed
+        #fetch and never replaces the last good snapshot
+        fresh.save(parsed + '.tmp')
+        os.replace(body + '.tmp', body)
+        os.replace(parsed + '.tmp', parsed)
+        self.write_meta(metapath, dict(validators, url=url, fetched=time.time()))
+        return fresh
+
+    def write_meta(self, metapath, meta):
+        "Write the metadata of a snapshot to 'metapath'"
+        with open(metapath + '.tmp', 'w') as fout:
+            json.dump(meta, fout)
+        os.replace(metapath + '.tmp', metapath)
@@ -0,0 +1,114 @@
+import io
+import os
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+
+FORMATS = {'.png': 'PNG', '.jpg': 'JPEG', '.jpeg': 'JPEG', '.webp': 'WEBP'}
+#PIL format of each file extension; other extensions are saved as PNG
+
+SETTINGS = {'PNG': {'compress_level': 6}, 'JPEG': {'quality': 85}, 'WEBP': {'quality': 80, 'method': 4}}
+#encoder settings of each format, PIL's own defaults for PNG and JPEG
+
+FAST = {'PNG': {'compress_level': 1}, 'JPEG': {'quality': 85}, 'WEBP': {'quality': 80, 'method': 0}}
+#encoder settings for latency-sensitive renders, which encode PNG in about
+#half the time for files about a third larger
+
+class Output:
+    """
+    One encoding of a rendered map: the file it is saved to, the size it is
+    resampled down to, its PIL format and encoder settings. Given a width or a
+    height alone, the other follows the aspect ratio of the map; given both,
+    the map is fitted inside them. Without either the map is saved at its
+    usual size, which is the size it was drawn at unless told otherwise.
+    """
+
+    def __init__(self, path, width=None, height=None, format=None, fast=False, **params):
+        self.path = path
+        self.width = width
+        self.height = height
+        extension = os.path.splitext(path)[1].lower() if isinstance(path, str) else ''
+        self.format = format or FORMATS.get(extension, 'PNG')
+        self.params = dict((FAST if fast else SETTINGS).get(self.format, {}), **params)
+
+    def __repr__(self):
+        return "Output({!r}, {}x{}, {})".format(self.path, self.width, self.height, self.format)
+
+    @classmethod
+    def parse(cls, spec, fast=False):
+        '''
+        Returns the Output described by 'spec', a file name optionally
+        followed by a colon and a size as WIDTH, WIDTHx or xHEIGHT or
+        WIDTHxHEIGHT, such as thumb.jpg:256 or map.webp:800x600
+        '''
+        path, colon, size = spec.rpartition(':')
+        if not colon or not size.replace('x', '').isdigit():
+            return cls(spec, fast=fast)
+        width, x, height = size.partition('x')
+        return cls(path, int(width) if width else None, int(height) if height else None, fast=fast)
+
+    def size(self, size):
+        "Return the size a map drawn at 'size' is saved at"
+        width, height = size
+        if self.width and self.height:
+            scale = min(self.width/width, self.height/height)
+        elif self.width:
+            scale = self.width/width
+        elif self.height:
+            scale = self.height/height
+        else:
+            return size
+        return max(1, round(width*scale)), max(1, round(height*scale))
+
+    def save(self, image, fp=None, default=None):
+        '''
+        Resamples 'image' to the size of the output and saves it in the
+        output's format to fp, a file name or file object, or to the output's
+        path. An output without a size is saved at the size 'default', if
+        given, such as the usual size of a map drawn larger for another
+        output. Images are only ever resampled down: an output larger than the
+        image is saved at the size of the image, so maps should be drawn at
+        the size of the largest output. Returns what it was saved to.
+        '''
+        size = self.size(image.size) if self.width or self.height else default or image.size
+        if size[0] > image.width or size[1] > image.height:
+            size = image.size
+        if size != image.size:
+            image = image.resize(size, Image.Resampling.LANCZOS, reducing_gap=3.0)
+        if image.mode == 'RGBA' and self.format == 'JPEG':
+            image = Image.alpha_composite(Image.new('RGBA', image.size, 'WHITE'), image).convert('RGB')
+            #JPEG has no transparency, so transparent parts are made white
+        fp = self.path if fp is None else fp
+        image.save(fp, self.format, **self.params)
+        return fp
+
+    def encode(self, image, default=None):
+        "Return 'image' resampled and encoded as the output would save it, as bytes"
+        buffer = io.BytesIO()
+        self.save(image, buffer, default)
+        return buffer.getvalue()
+
+def outputs(specs, fast=False):
+    '''
+    Returns a list of Outputs from a file name, a file object, an Output, or
+    a list of them, with file names read by Output.parse and file objects
+    saved to as PNG
+    '''
+    if not isinstance(specs, (list, tuple)):
+        specs = [specs]
+    return [spec if isinstance(spec, Output) else Output.parse(spec, fast) if isinstance(spec, str)
+    else Output(spec, fast=fast) for spec in specs]
+
+def save_all(image, specs, threads=None, fast=False, default=None):
+    '''
+    Saves one drawn map to every output in 'specs', as read by outputs,
+    resampling and encoding them in parallel threads, as PIL lets other
+    threads run while it resamples and compresses. Outputs without a size
+    are saved at the size 'default', as Output.save does. Returns the paths
+    saved.
+    '''
+    targets = outputs(specs, fast)
+    if len(targets) == 1 or threads == 1:
+        return [target.save(image, default=default) for target in targets]
+    image.load()
+    with ThreadPoolExecutor(threads) as pool:
+        return list(pool.map(lambda target: target.save(image, default=default), targets))
@@ -1,8 +1,35 @@
 from PIL import Image, ImageDraw, ImageFont
-from PIL.ImageColor import getrgb
-from region import Point
+from PIL.ImageColor import getrgb, getcolor
 from region import Region
 import math
+from collections import OrderedDict
+import numpy as np
+import instrument
+
+LAYERS = 256
+#number of static layers kept by Plot, enough for the four layers of each of
+#the layouts that map.section_layout keeps
+
+class LayerCache(OrderedDict):
+    """
+    A dict that keeps at most 'size' items, dropping the one used least
+    recently when it is full, so that drawing many sections at many sizes
+    does not grow it without limit.
+    """
+
+    def __init__(self, size):
+        super().__init__()
+        self.size = size
+
+    def __getitem__(self, key):
+        self.move_to_end(key)
+        return super().__getitem__(key)
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.move_to_end(key)
+        if len(self) > self.size:
+            self.popitem(last=False)
 
 class Plot:
 
@@ -29,20 +56,56 @@ class Plot:
             int: a new height
         """
         return int(height*(new_width/width))
+    _palettes = {}
+    #palettes built by Plot.palette, keyed by the items of their colorscale
+    _layers = LayerCache(LAYERS)
+    #static layers built by Plot.border_mask, Plot.section_mask, Plot.section_cells
+    #and Plot.legend_layer, the LAYERS used most recently
+    _fonts = {}
+    #fonts loaded by Plot.font, keyed by size
+    WIDTH = 1024
+    #width in pixels that the legend, wind glyphs and borders are sized for
+    LEGEND = 200
+    #height in pixels of the legend of a plot WIDTH pixels wide
+    @staticmethod
+    def palette(colorscale):
+        """
+        return the lowest value in colorscale and a list of RGB values where
+        entry i holds the color of value lowest + i, for use as the palette of
+        a "P" mode image. Values missing from colorscale take the color of the
+        closest lower value.
+        """
+        key = tuple(sorted(colorscale.items()))
+        if key not in Plot._palettes:
+            lowest = int(key[0][0])
+            rgb = []
+            for num, color in key:
+                while len(rgb) < int(num) - lowest:
+                    rgb.extend(rgb[-3:])
+                rgb.extend(getrgb(color))
+            Plot._palettes[key] = (lowest, rgb)
+        return Plot._palettes[key]
 
-    def __init__(self, min_long, min_lat, max_long, max_lat):
+    def __init__(self, min_long, min_lat, max_long, max_lat, width=1024, legend=200, pixels=None, scale=1):
         """
         Create a width x height image where height is proportional to width
-        with respect to the long/lat coordinates.
+        with respect to the long/lat coordinates, with legend pixels of space
+        below it for the legend. Plots of the same bounding box and width may
+        share the dict 'pixels' that the pixel spans of grid cells are kept in.
+        The legend, wind glyphs and borders are drawn 'scale' times their
+        usual size, such as width/WIDTH for a larger copy of a map.
         """
-        self.width = 1024
+        self.width = width
+        self.scale = scale
         self.min_long = min_long
         self.min_lat = min_lat
         self.max_long = max_long
         self.max_lat = max_lat
         self.height = Plot.proportional_height(self.width, self.max_long-self.min_long, self.max_lat-self.min_lat)
-        self.image = Image.new("RGB",(self.width, self.height+200), (255,255,255))
+        self.image = Image.new("RGB",(self.width, self.height+legend), (255,255,255))
         #image height adjusted to allow space for legend
+        self.pixels = {} if pixels is None else pixels
+        #cell_pixels of each grid drawn, by grid key
     def trans_long(self, longi):
         '''
         returns interpolated longitudinal value
@@ -53,9 +116,9 @@ class Plot:
         returns interpolated latitudinal value
         '''
         return self.height - Plot.interpolate(lati,self.min_lat, self.max_lat, self.height)
-    def save(self, filename):
-        """save the current image to 'filename'"""
-        self.image.save(filename, "PNG")
+    def save(self, filename, format="PNG", **params):
+        """save the current image to 'filename' in 'format' with PIL's encoder settings 'params'"""
+        self.image.save(filename, format, **params)
     def draw(self, region, color, border=None):
         """
         Draws 'region' in the given 'style' at the correct position on the
@@ -68,70 +131,370 @@ class Plot:
 
         coords = [(self.trans_long(x), self.trans_lat(y)) for x,y in zip(region.longs(), region.lats())]
         ImageDraw.Draw(self.image).polygon(coords, color, border)
+        instrument.count('polygons_drawn')
+    def cell_pixels(self, grid):
+        """
+        returns the grid column covering each pixel column and the grid row
+        covering each pixel row of the map, or -1 where a pixel is outside the
+        grid. A pixel on the edge of two cells goes to the cell east or north of
+        the edge, as it would when drawing the cells as polygons from south-west
+        to north-east. Worked out once per grid.
+        """
+        if grid.key() in self.pixels:
+            return self.pixels[grid.key()]
+        xs = np.floor(self.trans_long(grid.long_edges))
+        ys = np.floor(self.trans_lat(grid.lat_edges))
+        #pixel edges of the columns and rows, rounded the way ImageDraw rounds
+        #polygon corners
+        pixel_x = np.arange(self.width)
+        pixel_y = np.arange(self.height)
+        cols = np.searchsorted(xs[:-1], pixel_x, 'right') - 1
+        rows = np.minimum(np.searchsorted(-ys, -pixel_y, 'right') - 1, grid.rows - 1)
+        cols = np.where((cols >= 0) & (pixel_x <= xs[-1]), cols, -1)
+        rows = np.where((rows >= 0) & (pixel_y >= ys[-1]), rows, -1)
+        self.pixels[grid.key()] = (cols, rows)
+        return cols, rows
+    def section_mask(self, regions, key):
+        '''
+        returns a height x width boolean array of the pixels of the map inside
+        regions, their outlines included. The mask is drawn once and reused
+        for every plot with the same key, size and bounding box, as the
+        border mask is.
+        '''
+        cachekey = ('section', key, (self.width, self.height), self.min_long, self.min_lat, self.max_long, self.max_lat)
+        if cachekey not in Plot._layers:
+            mask = Image.new('L', (self.width, self.height), 0)
+            draw = ImageDraw.Draw(mask)
+            for region in regions:
+                draw.polygon([(self.trans_long(x), self.trans_lat(y)) for x,y in zip(region.longs(), region.lats())], 255, 255)
+            Plot._layers[cachekey] = np.asarray(mask) > 0
+        return Plot._layers[cachekey]
+    def section_cells(self, regions, key, grid):
+        '''
+        returns a rows x cols boolean array of the cells of grid that cover
+        at least one pixel of the section mask of regions, which are the only
+        cells a field clipped to the section needs. Kept with the mask.
+        '''
+        cachekey = ('cells', key, (self.width, self.height), self.min_long, self.min_lat, self.max_long, self.max_lat,
+        grid.key())
+        if cachekey not in Plot._layers:
+            cols, rows = self.cell_pixels(grid)
+            ys, xs = np.nonzero(self.section_mask(regions, key) & (rows >= 0)[:, None] & (cols >= 0)[None, :])
+            cells = np.zeros(grid.shape(), dtype=bool)
+            cells[rows[ys], cols[xs]] = True
+            Plot._layers[cachekey] = cells
+        return Plot._layers[cachekey]
+    def section_points(self, regions, key, xs, ys):
+        '''
+        returns a boolean array of whether each long/lat point (xs[i], ys[i])
+        falls on a pixel of the section mask of regions, used to keep wind
+        glyphs inside the section
+        '''
+        mask = self.section_mask(regions, key)
+        px = np.floor(self.trans_long(np.asarray(xs, dtype=float))).astype(int)
+        py = np.floor(self.trans_lat(np.asarray(ys, dtype=float))).astype(int)
+        ok = (px >= 0) & (px < self.width) & (py >= 0) & (py < self.height)
+        inside = np.zeros(np.shape(xs), dtype=bool)
+        inside[ok] = mask[py[ok], px[ok]]
+        return inside
+    @staticmethod
+    def color_indices(values, colorscale):
+        """
+        returns the palette index of the color of each value, as used with the
+        palette of Plot.palette(colorscale). Values are truncated to ints like
+        int() and clamped to the ends of the scale.
+        """
+        lowest, rgb = Plot.palette(colorscale)
+        return np.clip(np.trunc(values) - lowest, 0, len(rgb)//3 - 1).astype(np.uint8)
+    def draw_field(self, grid, values, colorscale, cells=None, clip=None):
+        """
+        Fills the whole map with the colors of a field of values in one
+        operation rather than one polygon per cell.
+        Args:
+            grid (Grid): the grid the values were sampled on
+            values (array): rows x cols array of values, row 0 being the southernmost
+            colorscale (dict): maps int values to hex colors; values are truncated
+            to ints like int() and clamped to the ends of the scale
+            cells (array): optional rows x cols boolean array of the cells to
+            fill; the pixels of other cells are left as they are, and their
+            values are not read
+            clip (array): optional height x width boolean array of the pixels
+            to fill, such as a mask from section_mask
+        """
+        if cells is not None:
+            values = np.where(cells, values, 0)
+        indices = Plot.color_indices(values, colorscale)
+        cols, rows = self.cell_pixels(grid)
+        inside = (cols >= 0)[None, :] & (rows >= 0)[:, None]
+        if cells is not None:
+            inside &= np.asarray(cells)[np.maximum(rows, 0)][:, np.maximum(cols, 0)]
+        if clip is not None:
+            inside &= clip
+        pixels = indices[np.maximum(rows, 0)][:, np.maximum(cols, 0)]
+        field = Image.fromarray(pixels, 'P')
+        field.putpalette(Plot.palette(colorscale)[1])
+        mask = None if inside.all() else Image.fromarray(inside.astype(np.uint8)*255, 'L')
+        self.image.paste(field.convert('RGB'), (0, 0), mask)
+    def draw_cells(self, grid, rows, cols, values, colorscale):
+        """
+        Repaints only the cells (rows[i], cols[i]) of a field drawn by
+        draw_field, with the colors of values[i]
+        """
+        rgb = Plot.palette(colorscale)[1]
+        indices = Plot.color_indices(values, colorscale)
+        pixel_cols, pixel_rows = self.cell_pixels(grid)
+        x_spans = {}
+        y_spans = {}
+        for spans, cells in ((x_spans, pixel_cols), (y_spans, pixel_rows)):
+            for pixel, cell in enumerate(cells.tolist()):
+                if cell >= 0:
+                    first, last = spans.get(cell, (pixel, pixel))
+                    spans[cell] = (min(first, pixel), max(last, pixel))
+        #first and last pixel of each column and row of the grid
+        draw = ImageDraw.Draw(self.image)
+        for r, c, i in zip(np.ravel(rows).tolist(), np.ravel(cols).tolist(), np.ravel(indices).tolist()):
+            if c in x_spans and r in y_spans:
+                draw.rectangle([x_spans[c][0], y_spans[r][0], x_spans[c][1], y_spans[r][1]], tuple(rgb[3*i:3*i+3]))
     def draw_arrow(self, reg, windspeed, winddirection, color, width):
         '''
-        draws an arrow from point start to point end, where point1 and point2
-        are the points of the arrow
+        draws an arrow starting at the midpoint of region reg
         '''
-        SPEEDSCALE = 5
-        #SPEEDSCALE used to scale size of wind vectors
-
-        def rotate(p1,p2, angle):
-            '''returns the coordinates of a point p2 rotated about another point p1'''
-            radangle = math.radians(angle)
-            rotated_p = Point(p1.getx() + (p2.getx()-p1.getx())*math.cos(radangle)+(p2.gety()-p1.gety())*math.sin(radangle),
-                        p1.gety() - (p2.getx()-p1.getx())*math.sin(radangle)+(p2.gety()-p1.gety())*math.cos(radangle))
-            return rotated_p
-        start = Point(reg.midpoint()[0], reg.midpoint()[1])
-        #starting point of vector
-        transstart = Point(self.trans_long(start.getx()), self.trans_lat(start.gety()))
-        #starting point interpolated
-        scaler = Point(transstart.getx(),transstart.gety()+windspeed*SPEEDSCALE)
-        #point vertical from starting point, with distance based on wind speed
-        end = rotate(transstart, scaler ,-winddirection)
-        #scaler rotated about starting point
-        transpoint1 = rotate(transstart, Point(scaler.getx()+transstart.distance(scaler)/10, scaler.gety()-(transstart.distance(scaler)/10)),-winddirection)
-        transpoint2 = rotate(transstart, Point(scaler.getx()-transstart.distance(scaler)/10, scaler.gety()-(transstart.distance(scaler)/10)),-winddirection)
-        #points used to create a triangle where one point is the end point of the vector,
-        #and other points are shifted along the line to form an arrow when plotted
-        #constants are for scaling the visualization
-        ImageDraw.Draw(self.image).line([(transstart.getx(),transstart.gety()),(end.getx(),end.gety())], color, width)
-        #drawing line portion of vector
-        ImageDraw.Draw(self.image).polygon([(transpoint1.getx(),transpoint1.gety()),(end.getx(),end.gety()),
-        (transpoint2.getx(),transpoint2.gety())],color,color)
-        #drawing triangle arrowhead of vector
+        x, y = reg.midpoint()
+        self.draw_arrow_at(x, y, windspeed, winddirection, color, width)
+    def draw_arrow_at(self, x, y, windspeed, winddirection, color, width):
+        '''
+        draws an arrow starting at the long/lat point (x, y), pointing the way
+        the wind blows with a length based on wind speed
+        '''
+        self.draw_arrows([x], [y], [windspeed], [winddirection], color, width)
+    SPEEDSCALE = 5
+    #length in pixels of a wind arrow per knot of wind speed
+    def arrow_geometry(self, xs, ys, windspeeds, winddirections):
+        '''
+        returns n x 2 arrays of the pixel coordinates of the start, the end and
+        the two outer corners of the arrowhead of the arrow at each long/lat
+        point (xs[i], ys[i]), computed for every arrow at once
+        '''
+        startx = self.trans_long(np.asarray(xs, dtype=float))
+        starty = self.trans_lat(np.asarray(ys, dtype=float))
+        #starting point of each vector, interpolated
+        length = (starty + np.asarray(windspeeds, dtype=float)*Plot.SPEEDSCALE*self.scale) - starty
+        #distance from each starting point to the point vertically below it,
+        #based on wind speed
+        radangle = np.radians(-np.asarray(winddirections, dtype=float))
+        cos, sin = np.cos(radangle), np.sin(radangle)
+        def rotate(dx, dy):
+            '''returns the points offset by (dx, dy) from the starting points, rotated about them'''
+            return np.stack((startx + dx*cos + dy*sin, starty - dx*sin + dy*cos), axis=-1)
+        head = np.abs(length)/10
+        #arrowhead corners are shifted along and across the line by a tenth
+        #of its length to form an arrow when plotted
+        return (np.stack((startx, starty), axis=-1), rotate(0.0, length), rotate(head, length - head),
+        rotate(-head, length - head))
+    def draw_arrows(self, xs, ys, windspeeds, winddirections, color, width):
+        '''
+        draws an arrow at each long/lat point (xs[i], ys[i]) as draw_arrow_at
+        does, computing every arrow's geometry together and drawing them all
+        with one draw context
+        '''
+        starts, ends, corners1, corners2 = (a.tolist() for a in
+        self.arrow_geometry(np.ravel(xs), np.ravel(ys), np.ravel(windspeeds), np.ravel(winddirections)))
+        instrument.count('glyphs_drawn', len(starts))
+        width = max(1, round(width*self.scale))
+        draw = ImageDraw.Draw(self.image)
+        for start, end, corner1, corner2 in zip(starts, ends, corners1, corners2):
+            draw.line([tuple(start), tuple(end)], color, width)
+            #drawing line portion of vector
+            draw.polygon([tuple(corner1), tuple(end), tuple(corner2)], color, color)
+            #drawing triangle arrowhead of vector
+    BARBLENGTH = 26
+    #length in pixels of the staff of a wind barb
+    FEATHER = 11
+    #length in pixels of a full barb
+    SPACING = 4
+    #pixels between the barbs along the staff
+    SUPERSAMPLE = 4
+    #barb sprites are drawn this many times larger and scaled down, to smooth them
+    _sprites = {}
+    #wind barb masks drawn by Plot.barb_sprite, keyed by speed and direction
+    @staticmethod
+    def barb_buckets(windspeeds, winddirections):
+        '''
+        returns the wind speeds rounded to the nearest 5 knots and the wind
+        directions rounded to the nearest 10 degrees, which are the speeds and
+        directions wind barbs can show
+        '''
+        speeds = (np.floor(np.asarray(windspeeds, dtype=float)/5 + 0.5)*5).astype(int)
+        directions = (np.floor(np.asarray(winddirections, dtype=float)/10 + 0.5)*10).astype(int) % 360
+        return speeds, directions
+    @staticmethod
+    def barb_sprite(windspeed, winddirection, size=1):
+        '''
+        returns an "L" mode mask of the standard wind barb for a speed in knots
+        that is a multiple of 5 and a direction that the wind blows from,
+        cropped to the barb, and the offset of the station from the top left
+        corner of the mask, 'size' times the usual size of a barb. Each barb is
+        drawn once.
+        The staff points into the wind, with a pennant for every 50 knots, a
+        full barb for every 10 and a half barb for 5 left over, on the
+        clockwise side of the staff. Calm wind is drawn as a circle.
+        '''
+        key = (windspeed, winddirection, size)
+        if key in Plot._sprites:
+            return Plot._sprites[key]
+        scale = max(1, round(Plot.SUPERSAMPLE*size))
+        #pixels drawn per pixel of a barb of the usual size
+        centre = (Plot.BARBLENGTH + Plot.FEATHER + 2)*scale
+        sprite = Image.new('L', (2*centre + scale, 2*centre + scale), 0)
+        draw = ImageDraw.Draw(sprite)
+        c = centre + scale/2
+        weight = 3*scale//2
+        #lines are a pixel and a half wide once scaled down
+        if windspeed == 0:
+            r = 3*scale
+            draw.ellipse([c - r, c - r, c + r, c + r], None, 255, weight)
+        else:
+            radangle = math.radians(winddirection)
+            staff = (math.sin(radangle), -math.cos(radangle))
+            #unit vector in pixels from the station into the wind
+            side = (math.cos(radangle), math.sin(radangle))
+            #unit vector across the staff, on its clockwise side
+            feather = ((side[0] + 0.4*staff[0])*Plot.FEATHER*scale, (side[1] + 0.4*staff[1])*Plot.FEATHER*scale)
+            along = lambda d: (c + staff[0]*d*scale, c + staff[1]*d*scale)
+            pos = Plot.BARBLENGTH
+            draw.line([(c, c), along(pos)], 255, weight)
+            remaining = windspeed
+            while remaining >= 50:
+                base = along(pos - 1.5*Plot.SPACING)
+                tip = along(pos)
+                draw.polygon([tip, (tip[0] + feather[0], tip[1] + feather[1]), base], 255, 255)
+                pos -= 1.5*Plot.SPACING + 1
+                remaining -= 50
+            if remaining < 10 and remaining == windspeed:
+                pos -= Plot.SPACING
+            #a lone half barb is set in from the end of the staff
+            while remaining >= 5:
+                f = 1 if remaining >= 10 else 0.5
+                start = along(pos)
+                draw.line([start, (start[0] + f*feather[0], start[1] + f*feather[1])], 255, weight)
+                pos -= Plot.SPACING
+                remaining -= 10 if remaining >= 10 else 5
+        sprite = sprite.resize((sprite.width//Plot.SUPERSAMPLE, sprite.height//Plot.SUPERSAMPLE), Image.BOX)
+        box = sprite.getbbox()
+        Plot._sprites[key] = (sprite.crop(box), (centre//Plot.SUPERSAMPLE - box[0], centre//Plot.SUPERSAMPLE - box[1]))
+        #masks are cropped so that stamping them only touches the barb's pixels
+        return Plot._sprites[key]
+    def draw_barbs(self, xs, ys, windspeeds, winddirections, color):
+        '''
+        draws the standard wind barb at each long/lat point (xs[i], ys[i]),
+        stamping sprites from barb_sprite onto the image in color
+        '''
+        speeds, directions = Plot.barb_buckets(np.ravel(windspeeds), np.ravel(winddirections))
+        color = getcolor(color, self.image.mode) if isinstance(color, str) else color
+        pxs = np.rint(self.trans_long(np.ravel(xs).astype(float))).astype(int).tolist()
+        pys = np.rint(self.trans_lat(np.ravel(ys).astype(float))).astype(int).tolist()
+        instrument.count('glyphs_drawn', len(pxs))
+        for px, py, speed, direction in zip(pxs, pys, speeds.tolist(), directions.tolist()):
+            sprite, (dx, dy) = Plot.barb_sprite(speed, direction, self.scale)
+            self.image.paste(color, (px - dx, py - dy, px - dx + sprite.width, py - dy + sprite.height), sprite)
 
-    def draw_legend(self, section, timedate, colorscale):
+    def border_mask(self, regions, key):
         '''
-        draws a legend at base of image to describe data displayed
+        returns an "L" mode mask of the outlines of regions the size of the image.
+        The mask is drawn once and reused for every plot with the same key,
+        size and bounding box, so key should name the set of regions, such as
+        the section they make up.
+        '''
+        cachekey = ('borders', key, self.image.size, self.scale, self.min_long, self.min_lat, self.max_long, self.max_lat)
+        if cachekey not in Plot._layers:
+            mask = Image.new('L', self.image.size, 0)
+            draw = ImageDraw.Draw(mask)
+            for region in regions:
+                draw.polygon([(self.trans_long(x), self.trans_lat(y)) for x,y in zip(region.longs(), region.lats())], None, 255,
+                self.px(1))
+            instrument.count('polygons_drawn', len(regions))
+            Plot._layers[cachekey] = mask
+        return Plot._layers[cachekey]
+    def draw_borders(self, regions, key, border=(0,0,0)):
+        '''
+        draws the outlines of regions in the border color by compositing the
+        cached mask from border_mask onto the image
         '''
-        ImageDraw.Draw(self.image).rectangle([0,self.height, self.width, self.height+200], 'WHITE')
-        #white rectangle used to eliminate arrow vectors that have passed beyond the southern
+        self.image.paste(border, (0, 0) + self.image.size, self.border_mask(regions, key))
+    def draw_outlines(self, regions, border=(0,0,0)):
+        '''
+        draws the outlines of regions in the border color straight onto the
+        image, for plots that are only drawn once, such as map tiles, where
+        caching a mask as draw_borders does would not pay off
+        '''
+        draw = ImageDraw.Draw(self.image)
+        for region in regions:
+            draw.polygon([(self.trans_long(x), self.trans_lat(y)) for x,y in zip(region.longs(), region.lats())], None, border)
+    @staticmethod
+    def font(size):
+        '''
+        returns the legend font at the given size, loaded once
+        '''
+        if size not in Plot._fonts:
+            Plot._fonts[size] = ImageFont.truetype('FreeSans.ttf', size)
+        return Plot._fonts[size]
+    def px(self, pixels):
+        '''
+        returns a length in pixels of a plot WIDTH pixels wide scaled to this
+        plot, rounded to a whole number of pixels
+        '''
+        return round(pixels*self.scale)
+    def legend_layer(self, section, colorscale, glyphs='arrows'):
+        '''
+        returns an image of the legend without the time and date, laid out for
+        a plot WIDTH pixels wide and scaled to this one. The legend depends
+        only on the section, the width and scale, the colorscale and whether
+        wind is drawn as arrows or barbs, so it is drawn once for each of them
+        and reused.
+        '''
+        cachekey = ('legend', section, self.width, self.scale, tuple(sorted(colorscale.items())), glyphs)
+        if cachekey in Plot._layers:
+            return Plot._layers[cachekey]
+        px = self.px
+        image = Image.new("RGB", (self.width, self.image.height - self.height), 'WHITE')
+        #white background used to eliminate arrow vectors that have passed beyond the southern
         #border of the map to avoid ugliness
-        SHIFT = (750//len(colorscale))
+        draw = ImageDraw.Draw(image)
+        SHIFT = (px(750)//len(colorscale))
         #value used to draw rectangles for each color in the color gradient and some
         #corresponding temperature values from colorscale
-        X0 = 100
-        Y0 = self.height + 100
-        fontsize = 20
-        font = ImageFont.truetype('FreeSans.ttf', fontsize)
-        ImageDraw.Draw(self.image).text((15,Y0+35),text = 'Temp(C):', font = font, fill = 'BLACK')
+        X0 = px(100)
+        Y0 = px(100)
+        font = Plot.font(px(20))
+        draw.text((px(15),Y0+px(35)),text = 'Temp(C):', font = font, fill = 'BLACK')
         for num in sorted(colorscale):
             if int(num)%5 == 0:
             #temperature values divisible by 5 are displayed to make color scale
             #more comprehensible
-                ImageDraw.Draw(self.image).text((X0,Y0+35),text = str(num), font = font, fill = 'BLACK')
-            ImageDraw.Draw(self.image).rectangle([(X0,Y0),(X0+SHIFT),(Y0+30)], colorscale[num])
+                draw.text((X0,Y0+px(35)),text = str(num), font = font, fill = 'BLACK')
+            draw.rectangle([(X0,Y0),(X0+SHIFT),(Y0+px(30))], colorscale[num])
             X0+=SHIFT
-        ImageDraw.Draw(self.image).text((20,self.height+5), text = timedate, font = font, fill = 'BLACK')
-        #drawing time and date
         if '_' in str(section):
             no_underscore = ' '.join(section.split('_'))
-            ImageDraw.Draw(self.image).text([(self.width/2)-200 ,(self.height+5)], text = 'Location:' + no_underscore, font = font, fill = 'BLACK')
+            draw.text([(self.width/2)-px(200) ,px(5)], text = 'Location:' + no_underscore, font = font, fill = 'BLACK')
         else:
-            ImageDraw.Draw(self.image).text([(self.width/2)-200 ,(self.height+5)], text = 'Location:' + section, font = font, fill = 'BLACK')
+            draw.text([(self.width/2)-px(200) ,px(5)], text = 'Location:' + section, font = font, fill = 'BLACK')
         #drawing section, replacing the underscore separating names with two words with a space if applicable
-        ImageDraw.Draw(self.image).text((675,self.height+5),text = 'The wind direction and magnitude are \n displayed in vector form.', font = font, fill = 'BLACK')
+        if glyphs == 'barbs':
+            draw.text((px(675),px(5)),text = 'Wind barbs point into the wind. \n Half barb 5 kt, barb 10 kt, \n pennant 50 kt.', font = font, fill = 'BLACK')
+        else:
+            draw.text((px(675),px(5)),text = 'The wind direction and magnitude are \n displayed in vector form.', font = font, fill = 'BLACK')
         #drawing information about vectors
-        ImageDraw.Draw(self.image).text((715,self.height+170),text = 'Source: http://aviationweather.gov/', font = font, fill = 'BLACK')
+        draw.text((px(715),px(170)),text = 'Source: http://aviationweather.gov/', font = font, fill = 'BLACK')
         #drawing credit for source of data
+        Plot._layers[cachekey] = image
+        return image
+    def draw_legend(self, section, timedate, colorscale, glyphs='arrows'):
+        '''
+        draws a legend at base of image to describe data displayed
+        '''
+        self.image.paste(self.legend_layer(section, colorscale, glyphs), (0, self.height))
+        #the cached legend covers everything but the time and date
+        ImageDraw.Draw(self.image).text((self.px(20),self.height+self.px(5)), text = timedate, font = Plot.font(self.px(20)),
+        fill = 'BLACK')
+        #drawing time and date
@@ -1,5 +1,17 @@
 import math
 import csv
+import numpy as np
+import instrument
+from stations import StationIndex
+from stations import SampleCache
+from stations import wind_components
+from stations import wind_polar
+
+def mercator(lat):
+    """project latitude 'lat' according to Mercator"""
+    lat_rad = (lat * math.pi) / 180
+    projection = math.log(math.tan((math.pi / 4) + (lat_rad / 2)))
+    return (180 * projection) / math.pi
 
 class Point:
     def __init__(self, x, y):
@@ -58,6 +70,10 @@ class Region:
     def temp_and_wind(self, stations):
         "Return a list containing the average temperature, wind speed, and wind"
         "direction readings from the closest 3 stations to a region's midpoint"
+        if isinstance(stations, (StationIndex, SampleCache)):
+            return stations.temp_and_wind(*self.midpoint())
+        #an index or sample cache answers the query directly; a plain list of
+        #stations is searched below
         INITIALVAL = (1000, 1000)
         #extremely high value used for initial comparison purposes in finding closest
         #stations and as a general placeholder
@@ -99,10 +115,12 @@ class Region:
         #the search radius within the list
         if startindex < 1:
             startindexsub=0
-            startindexadd=len(stations)-2
+            startindexadd=len(stations)
         #if no stations with int value longitude of the midpoint are found, the
         #entire list will be used in comparison
-        for station in stations[startindex - startindexsub:startindex + startindexadd]:
+        window = stations[startindex - startindexsub:startindex + startindexadd]
+        instrument.count('stations_scanned', len(window))
+        for station in window:
         #for each station in the determined search radius, the station's distance from
         #the midpoint of the region is compared to the distances of the points already
         #in the closestations list. The list is always length 3; whenever a new
@@ -145,7 +163,52 @@ class Region:
                 wind_directions.insert(0,float(station[7]))
             #if the station is not closer than any of the 3 points, the list remains
             #unchanged
-        average_readings = [float(sum(temps)/3),float(sum(wind_speeds)/3),float(sum(wind_directions)/3)]
+        filled = [i for i in range(3) if closestations[i].getx() != INITIALVAL[0]]
+        #slots still holding the placeholder, when fewer than 3 stations were
+        #searched, are left out of the averages
+        if not filled:
+            return [0.0, 0.0, 0.0]
+        u, v = wind_components([wind_speeds[i] for i in filled], [wind_directions[i] for i in filled])
+        w_speed, w_direction = wind_polar(u.mean(), v.mean())
+        #wind is averaged by its u and v components, so that directions either
+        #side of north average to north instead of south
+        average_readings = [float(sum(temps[i] for i in filled)/len(filled)),float(w_speed),float(w_direction)]
         return average_readings
-        #temperature, wind speed, and wind direction values are averaged based on the 3 values
+        #temperature, wind speed, and wind direction values are averaged based on the values
         #in their respective lists to gain a more accurate estimate of values at nearby points
+
+class Grid:
+    """
+    A long/lat bounding box partitioned into cols x rows rectangles of uniform
+    size, kept as arrays of cell edges instead of one Region per cell. Row 0 is
+    the southernmost row and column 0 the westernmost column.
+    """
+
+    def __init__(self, minlong, maxlong, minlat, maxlat, cols, rows):
+        self.cols = cols
+        self.rows = rows
+        self.long_edges = np.linspace(minlong, maxlong, cols + 1)
+        self.lat_edges = np.linspace(minlat, maxlat, rows + 1)
+
+    def __len__(self):
+        return self.cols*self.rows
+
+    def key(self):
+        "Return a hashable tuple of the bounding box and size of the grid"
+        return (float(self.long_edges[0]), float(self.long_edges[-1]), float(self.lat_edges[0]),
+        float(self.lat_edges[-1]), self.cols, self.rows)
+
+    def shape(self):
+        "Return the (rows, cols) shape of the arrays describing the grid"
+        return (self.rows, self.cols)
+
+    def bounds(self):
+        "Return rows x cols arrays of the min long, min lat, max long and max lat of each cell"
+        min_longs, min_lats = np.meshgrid(self.long_edges[:-1], self.lat_edges[:-1])
+        max_longs, max_lats = np.meshgrid(self.long_edges[1:], self.lat_edges[1:])
+        return min_longs, min_lats, max_longs, max_lats
+
+    def midpoints(self):
+        "Return rows x cols arrays of the long and lat of the midpoint of each cell"
+        return np.meshgrid((self.long_edges[:-1] + self.long_edges[1:])/2,
+        (self.lat_edges[:-1] + self.lat_edges[1:])/2)
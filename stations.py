@@ -0,0 +1,255 @@
+import copy
+import math
+import numpy as np
+import instrument
+
+def wind_components(speeds, directions):
+    '''
+    Returns the eastward (u) and northward (v) components of winds of the
+    given speeds blowing from the given directions in degrees, as METAR
+    reports them
+    '''
+    radians = np.radians(directions)
+    return -np.multiply(speeds, np.sin(radians)), -np.multiply(speeds, np.cos(radians))
+
+def wind_polar(u, v):
+    '''
+    Returns the speeds of winds with eastward and northward components u and
+    v, and the directions in degrees that they blow from, undoing
+    wind_components. Calm winds are given a direction of 0.
+    '''
+    speeds = np.hypot(u, v)
+    directions = np.where(speeds > 0, np.degrees(np.arctan2(np.negative(u), np.negative(v))) % 360, 0.0)
+    return speeds, directions
+
+class StationIndex:
+    """
+    A spatial index over weather stations, built once per METAR snapshot.
+    Stations are bucketed into a uniform grid of square cells over their
+    long/lat bounding box, so a nearest station query only looks at the
+    cells around the query point instead of the whole station list.
+    """
+    PER_CELL = 2
+    #average number of stations per bucket, used to size the cells
+
+    def __init__(self, longs, lats, temps, wind_speeds, wind_directions):
+        """
+        Build the index from parallel sequences of station values, where
+        lats have already been converted to mercator form.
+        """
+        self.longs = np.asarray(longs, dtype=float)
+        self.lats = np.asarray(lats, dtype=float)
+        self.temps = np.asarray(temps, dtype=float)
+        self.wind_speeds = np.asarray(wind_speeds, dtype=float)
+        self.wind_directions = np.asarray(wind_directions, dtype=float)
+        self.wind_u, self.wind_v = wind_components(self.wind_speeds, self.wind_directions)
+        #winds are averaged as vectors, so their components are worked out once
+        if len(self.longs) == 0:
+            raise ValueError('cannot index an empty list of stations')
+        self.min_long = float(self.longs.min())
+        self.min_lat = float(self.lats.min())
+        width = float(self.longs.max()) - self.min_long
+        height = float(self.lats.max()) - self.min_lat
+        self.cellsize = math.sqrt(max(width*height, 1e-9)*StationIndex.PER_CELL/len(self.longs))
+        self.cols = int(width/self.cellsize) + 1
+        self.rows = int(height/self.cellsize) + 1
+        cells = self.cell_row(self.lats)*self.cols + self.cell_col(self.longs)
+        self.order = np.argsort(cells, kind='stable')
+        #station indices grouped by bucket
+        self.starts = np.searchsorted(cells[self.order], np.arange(self.cols*self.rows + 1))
+        #stations in bucket c are self.order[self.starts[c]:self.starts[c+1]]
+
+    @classmethod
+    def from_snapshot(cls, snapshot):
+        "Build the index from a metar.Snapshot"
+        return cls(snapshot.longs, snapshot.lats, snapshot.temps, snapshot.wind_speeds,
+        snapshot.wind_directions)
+
+    def __len__(self):
+        return len(self.longs)
+
+    def same_stations(self, snapshot):
+        "Return whether 'snapshot' has the stations of this index, at the same positions in the same order"
+        return np.array_equal(self.longs, snapshot.longs) and np.array_equal(self.lats, snapshot.lats)
+
+    def with_readings(self, snapshot):
+        """
+        Return an index of the stations of 'snapshot', which must be the same
+        stations as this index's, sharing this index's buckets rather than
+        building them again
+        """
+        index = copy.copy(self)
+        index.temps = np.asarray(snapshot.temps, dtype=float)
+        index.wind_speeds = np.asarray(snapshot.wind_speeds, dtype=float)
+        index.wind_directions = np.asarray(snapshot.wind_directions, dtype=float)
+        index.wind_u, index.wind_v = wind_components(index.wind_speeds, index.wind_directions)
+        return index
+
+    def cell_col(self, longs):
+        "Return the bucket column of each longitude, clamped to the grid"
+        return np.clip(((longs - self.min_long)/self.cellsize).astype(int), 0, self.cols - 1)
+
+    def cell_row(self, lats):
+        "Return the bucket row of each latitude, clamped to the grid"
+        return np.clip(((lats - self.min_lat)/self.cellsize).astype(int), 0, self.rows - 1)
+
+    def nearest(self, x, y, k=3):
+        """
+        Return an array of the indices of the k stations closest to (x, y),
+        ordered from closest to furthest.
+        """
+        k = min(k, len(self))
+        col = int(self.cell_col(np.array([x]))[0])
+        row = int(self.cell_row(np.array([y]))[0])
+        found = np.empty(0, dtype=int)
+        dists = np.empty(0)
+        ring = 0
+        while True:
+            #gather the buckets on the square ring 'ring' cells away from the
+            #query bucket, then check whether the k closest stations seen so far
+            #are guaranteed to be closer than anything outside the searched square
+            lo_col, hi_col = col - ring, col + ring
+            lo_row, hi_row = row - ring, row + ring
+            new = []
+            for r in range(max(lo_row, 0), min(hi_row, self.rows - 1) + 1):
+                if r == lo_row or r == hi_row:
+                    cs = range(max(lo_col, 0), min(hi_col, self.cols - 1) + 1)
+                else:
+                    cs = [c for c in (lo_col, hi_col) if 0 <= c < self.cols]
+                for c in cs:
+                    cell = r*self.cols + c
+                    if self.starts[cell] != self.starts[cell+1]:
+                        new.append(self.order[self.starts[cell]:self.starts[cell+1]])
+            if new:
+                new = np.concatenate(new)
+                found = np.concatenate((found, new))
+                dists = np.concatenate((dists, np.hypot(self.longs[new] - x, self.lats[new] - y)))
+            covered = lo_col <= 0 and lo_row <= 0 and hi_col >= self.cols - 1 and hi_row >= self.rows - 1
+            if len(found) >= k:
+                if covered:
+                    break
+                edges = []
+                if lo_col > 0:
+                    edges.append(x - (self.min_long + lo_col*self.cellsize))
+                if hi_col < self.cols - 1:
+                    edges.append(self.min_long + (hi_col + 1)*self.cellsize - x)
+                if lo_row > 0:
+                    edges.append(y - (self.min_lat + lo_row*self.cellsize))
+                if hi_row < self.rows - 1:
+                    edges.append(self.min_lat + (hi_row + 1)*self.cellsize - y)
+                if np.partition(dists, k - 1)[k - 1] <= min(edges):
+                    break
+            ring += 1
+        instrument.count('stations_scanned', len(found))
+        closest = np.argsort(dists, kind='stable')[:k]
+        return found[closest]
+
+    def readings(self, closest):
+        """
+        Return the average temperature, wind speed, and wind direction of the
+        stations along the last axis of an array of station indices. Winds are
+        averaged by their u and v components, so 350 and 10 degrees average
+        to 0 degrees rather than 180.
+        """
+        speeds, directions = wind_polar(self.wind_u[closest].mean(axis=-1), self.wind_v[closest].mean(axis=-1))
+        return self.temps[closest].mean(axis=-1), speeds, directions
+
+    def temp_and_wind(self, x, y, k=3):
+        """
+        Return a list containing the average temperature, wind speed, and wind
+        direction readings from the closest k stations to (x, y)
+        """
+        return [float(reading) for reading in self.readings(self.nearest(x, y, k))]
+
+    def nearest_batch(self, xs, ys, k=3):
+        """
+        Return a len(xs) x k array of the indices of the k stations closest to
+        each point (xs[i], ys[i]), ordered from closest to furthest. All points
+        are searched together, ring by ring, until every point's k closest
+        stations are known.
+        """
+        xs = np.asarray(xs, dtype=float).ravel()
+        ys = np.asarray(ys, dtype=float).ravel()
+        k = min(k, len(self))
+        best_d = np.full((len(xs), k), np.inf)
+        best_i = np.zeros((len(xs), k), dtype=int)
+        cols = self.cell_col(xs)
+        rows = self.cell_row(ys)
+        counts = np.diff(self.starts)
+        active = np.arange(len(xs))
+        ring = 0
+        while len(active):
+            x, y = xs[active], ys[active]
+            c, r = cols[active], rows[active]
+            d_act, i_act = best_d[active], best_i[active]
+            if ring == 0:
+                offsets = [(0, 0)]
+            else:
+                offsets = [(dc, dr) for dr in range(-ring, ring + 1) for dc in range(-ring, ring + 1)
+                if max(abs(dc), abs(dr)) == ring]
+            d_all, i_all = [d_act], [i_act]
+            for dc, dr in offsets:
+                cc, rr = c + dc, r + dr
+                valid = (cc >= 0) & (cc < self.cols) & (rr >= 0) & (rr < self.rows)
+                cell = np.where(valid, rr*self.cols + cc, 0)
+                n = np.where(valid, counts[cell], 0)
+                m = int(n.max())
+                if m == 0:
+                    continue
+                if instrument.active():
+                    instrument.count('stations_scanned', int(n.sum()))
+                ok = np.arange(m) < n[:, None]
+                slots = np.where(ok, self.starts[cell][:, None] + np.arange(m), 0)
+                cand = self.order[slots]
+                d_all.append(np.where(ok, np.hypot(self.longs[cand] - x[:, None], self.lats[cand] - y[:, None]), np.inf))
+                i_all.append(cand)
+            if len(d_all) > 1:
+                d_all = np.concatenate(d_all, axis=1)
+                i_all = np.concatenate(i_all, axis=1)
+                keep = np.argpartition(d_all, k - 1, axis=1)[:, :k]
+                d_act = np.take_along_axis(d_all, keep, axis=1)
+                i_act = np.take_along_axis(i_all, keep, axis=1)
+            best_d[active], best_i[active] = d_act, i_act
+            #distance from each point to the nearest bucket outside the searched
+            #square, infinite when the square already covers the whole grid
+            radius = np.full(len(active), np.inf)
+            lo_col, hi_col, lo_row, hi_row = c - ring, c + ring, r - ring, r + ring
+            radius = np.where(lo_col > 0, np.minimum(radius, x - (self.min_long + lo_col*self.cellsize)), radius)
+            radius = np.where(hi_col < self.cols - 1, np.minimum(radius, self.min_long + (hi_col + 1)*self.cellsize - x), radius)
+            radius = np.where(lo_row > 0, np.minimum(radius, y - (self.min_lat + lo_row*self.cellsize)), radius)
+            radius = np.where(hi_row < self.rows - 1, np.minimum(radius, self.min_lat + (hi_row + 1)*self.cellsize - y), radius)
+            done = (d_act.max(axis=1) <= radius) | np.isinf(radius)
+            active = active[~done]
+            ring += 1
+        order = np.argsort(best_d, axis=1, kind='stable')
+        return np.take_along_axis(best_i, order, axis=1)
+
+class SampleCache:
+    """
+    Readings interpolated from a StationIndex, keyed by the point they were
+    sampled at, so grids whose cell midpoints coincide (such as a temperature
+    grid whose resolution is an odd multiple of the wind grid's) only look
+    each point up once. Temperature, wind speed and wind direction are
+    always sampled together. Used by the Region-per-cell path of map.draw;
+    the vectorized path keeps a stencil per grid in its Interpolator instead.
+    """
+    DIGITS = 9
+    #points are rounded to this many decimal places before comparison
+
+    def __init__(self, index, k=3):
+        self.index = index
+        self.k = k
+        self.samples = {}
+
+    def __len__(self):
+        return len(self.samples)
+
+    def temp_and_wind(self, x, y):
+        """
+        Return a list containing the average temperature, wind speed, and wind
+        direction readings from the closest stations to (x, y)
+        """
+        key = (round(float(x), SampleCache.DIGITS), round(float(y), SampleCache.DIGITS))
+        if key not in self.samples:
+            self.samples[key] = tuple(self.index.temp_and_wind(x, y, self.k))
+        return list(self.samples[key])
@@ -0,0 +1,249 @@
+import os
+import math
+import json
+import time
+import hashlib
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from PIL import Image, ImageDraw, ImageFilter
+import boundaries as boundarycache
+import map
+import metar
+import interpolation as engines
+from plot import Plot
+from region import Grid
+from region import Region
+from stations import StationIndex
+from stations import wind_polar
+
+TILESIZE = 256
+#width and height in pixels of a map tile
+
+MANIFEST = 'tiles.json'
+#file in the output directory holding the content hash of every tile written
+
+def tile_bounds(z, x, y):
+    '''
+    Returns the min long, min lat, max long and max lat of Web Mercator tile
+    x, y at zoom z, with lats in the mercator form of region.mercator, in
+    which every tile is square
+    '''
+    size = 360/2**z
+    return -180 + x*size, 180 - (y + 1)*size, -180 + (x + 1)*size, 180 - y*size
+
+def tile_coords(z, longs, lats):
+    '''
+    Returns the tile column and row, as fractions, of each long and mercator
+    lat at zoom z
+    '''
+    return (np.asarray(longs) + 180)/360*2**z, (180 - np.asarray(lats))/360*2**z
+
+def covering_tiles(z, outlines):
+    """
+    Returns the (x, y) numbers of the tiles at zoom z that the boundary
+    outlines, a list of n x 2 arrays of long and mercator lat values,
+    touch or lie within. The outlines are drawn onto an image with one
+    pixel per tile, grown by a pixel so that tiles an outline only grazes
+    are kept.
+    """
+    cols, rows = zip(*[tile_coords(z, outline[:, 0], outline[:, 1]) for outline in outlines])
+    x0 = max(int(min(c.min() for c in cols)) - 1, 0)
+    y0 = max(int(min(r.min() for r in rows)) - 1, 0)
+    x1 = min(int(max(c.max() for c in cols)) + 1, 2**z - 1)
+    y1 = min(int(max(r.max() for r in rows)) + 1, 2**z - 1)
+    mask = Image.new('L', (x1 - x0 + 1, y1 - y0 + 1), 0)
+    draw = ImageDraw.Draw(mask)
+    for c, r in zip(cols, rows):
+        draw.polygon(list(zip((c - x0).tolist(), (r - y0).tolist())), 255, 255)
+    mask = mask.filter(ImageFilter.MaxFilter(3))
+    ys, xs = np.nonzero(np.asarray(mask))
+    return list(zip((xs + x0).tolist(), (ys + y0).tolist()))
+
+_shared = {}
+#state shared by every tile rendered in a process, set by share()
+
+def glyph_reach(glyphs, windspeeds):
+    '''
+    Returns how many pixels a wind glyph of the kind 'glyphs' can reach from
+    the point it is drawn at, for winds no stronger than the largest of
+    'windspeeds'
+    '''
+    if glyphs == 'barbs':
+        return Plot.BARBLENGTH + Plot.FEATHER + 2
+    if glyphs == 'arrows':
+        return float(np.nanmax(windspeeds, initial=0))*Plot.SPEEDSCALE + 1
+    return 0
+
+def share(outlines, interpolator, digests, options):
+    '''
+    Stores the boundary outlines with their bounding boxes and the box
+    around them all, the interpolator, the content hashes of the tiles
+    already written, the render options and the reach of the wind glyphs for
+    render_tile. Runs once in each worker process of a pool.
+    '''
+    boxes = np.array([(o[:, 0].min(), o[:, 1].min(), o[:, 0].max(), o[:, 1].max()) for o in outlines])
+    extent = (boxes[:, 0].min(), boxes[:, 1].min(), boxes[:, 2].max(), boxes[:, 3].max())
+    reach = glyph_reach(options['glyphs'], interpolator.index.wind_speeds)
+    _shared.update(outlines=outlines, boxes=boxes, extent=extent, interpolator=interpolator, digests=digests,
+    options=options, reach=reach)
+
+def sample(interpolator, grid, readings):
+    '''
+    Returns a rows x cols boolean array of the cells of 'grid' whose
+    midpoints lie within the bounding box of the boundaries, and rows x cols
+    arrays of each of 'readings', one reading per station, interpolated onto
+    those cells and nan elsewhere. Cells outside the boundaries are left
+    out, as the nearest stations of a point far out to sea take a long
+    search to find.
+    '''
+    MINLONG, MINLAT, MAXLONG, MAXLAT = _shared['extent']
+    xs, ys = grid.midpoints()
+    cells = (xs >= MINLONG) & (xs <= MAXLONG) & (ys >= MINLAT) & (ys <= MAXLAT)
+    fields = [np.full(grid.shape(), np.nan) for values in readings]
+    if cells.any():
+        stencil = interpolator.weigh(grid, cells)
+        #stencils are not kept, as every tile has a grid of its own
+        for field, values in zip(fields, readings):
+            field[cells] = stencil.apply(values)
+    return cells, fields
+
+def render_tile(z, x, y, outdir):
+    """
+    Renders tile x, y at zoom z from the shared state and saves it as
+    outdir/z/x/y.png, unless the tile saved there was rendered from the same
+    content. The interpolated field is sampled once for the whole tile, on
+    cells aligned with those of its neighbours so that tiles meet without
+    seams, and the tile is transparent outside the bounding box of the
+    boundaries. Wind is also sampled in a margin of cells around the tile as
+    wide as a glyph reaches, so glyphs drawn from the cells of neighbouring
+    tiles are not cut off at the edge. The content hash is taken before
+    anything is sampled, from the positions and readings of the stations
+    the interpolator can draw on within the tile and its margin, and the
+    outlines drawn, so an unchanged tile costs a station query and no
+    interpolation. Returns the tile's name, its content hash and whether it
+    was written.
+    """
+    options = _shared['options']
+    interpolator = _shared['interpolator']
+    index = interpolator.index
+    bounds = tile_bounds(z, x, y)
+    MINLONG, MINLAT, MAXLONG, MAXLAT = bounds
+    g = Grid(MINLONG, MAXLONG, MINLAT, MAXLAT, options['resolution'], options['resolution'])
+    pad = math.ceil(_shared['reach']*options['wind_resolution']/TILESIZE)
+    size = (MAXLONG - MINLONG)/options['wind_resolution']
+    h = Grid(MINLONG - pad*size, MAXLONG + pad*size, MINLAT - pad*size, MAXLAT + pad*size,
+    options['wind_resolution'] + 2*pad, options['wind_resolution'] + 2*pad)
+    #wind cells of the tile and of a margin of pad cells around it
+    boxes = _shared['boxes']
+    near = np.flatnonzero((boxes[:, 0] <= MAXLONG) & (boxes[:, 2] >= MINLONG) & (boxes[:, 1] <= MAXLAT) &
+    (boxes[:, 3] >= MINLAT))
+    EXTENT = _shared['extent']
+    box = (max(MINLONG - pad*size, EXTENT[0]), max(MINLAT - pad*size, EXTENT[1]),
+    min(MAXLONG + pad*size, EXTENT[2]), min(MAXLAT + pad*size, EXTENT[3]))
+    #only cells within the bounding box of the boundaries are sampled
+    stations = interpolator.reach(box) if box[0] <= box[2] and box[1] <= box[3] else np.empty(0, dtype=int)
+    name = '{}/{}/{}'.format(z, x, y)
+    digest = hashlib.sha1()
+    digest.update(repr((name, sorted(options.items()), pad)).encode('utf-8'))
+    for values in [index.longs, index.lats, index.temps, index.wind_u, index.wind_v]:
+        digest.update(np.ascontiguousarray(values[stations]).tobytes())
+    for i in near:
+        digest.update(np.ascontiguousarray(_shared['outlines'][i]).tobytes())
+    #the outlines themselves are hashed, so editing the boundaries file
+    #renders the tiles they cross again
+    digest = digest.hexdigest()
+    path = os.path.join(outdir, str(z), str(x), '{}.png'.format(y))
+    if _shared['digests'].get(name) == digest and os.path.exists(path):
+        return name, digest, False
+    cells, (temps,) = sample(interpolator, g, [index.temps])
+    wind_cells, (u, v) = sample(interpolator, h, [index.wind_u, index.wind_v])
+    p = Plot(MINLONG, MINLAT, MAXLONG, MAXLAT, TILESIZE, 0)
+    p.image = Image.new('RGBA', p.image.size, (0, 0, 0, 0))
+    p.draw_field(g, temps, map.COLORS, cells)
+    speeds, directions = wind_polar(u[wind_cells], v[wind_cells])
+    xs, ys = h.midpoints()
+    xs, ys = xs[wind_cells], ys[wind_cells]
+    if options['glyphs'] == 'barbs':
+        p.draw_barbs(xs, ys, speeds, directions, 'BLACK')
+    elif options['glyphs'] == 'arrows':
+        p.draw_arrows(xs, ys, speeds, directions, 'BLACK', 1)
+    #glyphs from the margin are clipped by the edges of the tile
+    p.draw_outlines([Region(_shared['outlines'][i].tolist()) for i in near])
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    p.image.save(path + '.tmp', 'PNG')
+    os.replace(path + '.tmp', path)
+    return name, digest, True
+
+def render_tiles(boundaries, outdir, zooms=range(3, 8), location=map.URL, processes=None, cache=None,
+    interpolation='nearest', glyphs='barbs', resolution=64, wind_resolution=4):
+    """
+    Renders Web Mercator map tiles of the temperature and wind field into
+    'outdir', laid out as z/x/y.png for slippy map viewers, from a single
+    fetch of the METAR data. Only the tiles that the boundaries touch are
+    rendered, and tiles whose content is unchanged since the last run are
+    not written again. Returns the numbers of tiles written and skipped.
+    Args:
+        boundaries (str): name of a csv file of geographic information
+        outdir (str): directory to save the tiles in, created if missing
+        zooms: zoom levels to render
+        location: URL or csv file name of the METAR data, or a source object
+        from metar.py
+        processes (int): number of worker processes, defaulting to the number
+        of CPUs; 1 renders every tile in this process
+        cache (SnapshotCache): on-disk cache that URLs are fetched through
+        interpolation (str): name of the interpolator in interpolation.ENGINES
+        glyphs (str): 'barbs', 'arrows' or 'none' for how wind is drawn
+        resolution (int): rows and columns of temperature cells in each tile
+        wind_resolution (int): rows and columns of wind glyphs in each tile
+    """
+    outlines = boundarycache.load_boundaries(boundaries)
+    stations = map.fetch_stations(location, cache)
+    interpolator = engines.interpolator(interpolation, StationIndex.from_snapshot(stations))
+    manifest = os.path.join(outdir, MANIFEST)
+    try:
+        with open(manifest, 'r') as fin:
+            digests = json.load(fin)
+    except (OSError, ValueError):
+        digests = {}
+    options = {'resolution': resolution, 'wind_resolution': wind_resolution, 'glyphs': glyphs,
+    'interpolation': interpolation}
+    tasks = [(z, x, y) for z in zooms for x, y in covering_tiles(z, outlines)]
+    if processes == 1:
+        share(outlines, interpolator, digests, options)
+        results = [render_tile(z, x, y, outdir) for z, x, y in tasks]
+    else:
+        zs, xs, ys = zip(*tasks) if tasks else ((), (), ())
+        with ProcessPoolExecutor(processes, initializer=share,
+            initargs=(outlines, interpolator, digests, options)) as pool:
+            results = list(pool.map(render_tile, zs, xs, ys, [outdir]*len(tasks), chunksize=16))
+            #tiles are handed out in chunks, as each one is quick to render
+    os.makedirs(outdir, exist_ok=True)
+    with open(manifest + '.tmp', 'w') as fout:
+        json.dump({name: digest for name, digest, written in results}, fout)
+    os.replace(manifest + '.tmp', manifest)
+    written = sum(1 for result in results if result[2])
+    return written, len(results) - written
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Render Web Mercator map tiles of the temperature and wind field.')
+    parser.add_argument('boundaries', help='csv file of state boundaries (ex: states.csv)')
+    parser.add_argument('outdir', help='directory to save the tiles in, as z/x/y.png')
+    parser.add_argument('--zooms', type=int, nargs='+', default=list(range(3, 8)), help='zoom levels to render')
+    parser.add_argument('--source', default=map.URL, help='URL or csv file of METAR data')
+    parser.add_argument('--processes', type=int, default=None, help='number of worker processes')
+    parser.add_argument('--cache-dir', default='metar_cache',
+    help='directory that downloaded METAR data is kept in')
+    parser.add_argument('--max-age', type=float, default=300,
+    help='seconds that downloaded METAR data is reused for before checking for newer data')
+    parser.add_argument('--interpolation', choices=list(engines.ENGINES), default='nearest',
+    help='how readings are interpolated between stations')
+    parser.add_argument('--glyphs', choices=['barbs', 'arrows', 'none'], default='barbs', help='how wind is drawn')
+    parser.add_argument('--resolution', type=int, default=64, help='temperature cells across each tile')
+    parser.add_argument('--wind-resolution', type=int, default=4, help='wind glyphs across each tile')
+    args = parser.parse_args()
+    cache = metar.SnapshotCache(args.cache_dir, args.max_age)
+    start = time.time()
+    written, skipped = render_tiles(args.boundaries, args.outdir, args.zooms, args.source, args.processes, cache,
+    args.interpolation, args.glyphs, args.resolution, args.wind_resolution)
+    print('wrote {} tiles and skipped {} unchanged in {:.1f}s'.format(written, skipped, time.time() - start))